@@ -1,12 +1,77 @@
-import pygame 
 import sys 
+import os
 import math 
 import random 
+import time
+START_TIME = time.perf_counter()  # 脚本开始加载的时刻, 首帧时间从这里算起
+import json
+import platform
+import argparse
+import bisect
+import struct
+import threading
+from collections import deque
+# asyncio 和 concurrent.futures 只在服务器、并行计算等少数地方用到, 在用到的函数里才导入, 游戏启动时不必加载
+
+try:
+    import numpy as np
+except ImportError:  # 没有 numpy 时退回逐条追踪
+    np = None
  
 # 常量 
 MAX_BOUNCES = 5 
 RAY_PULSE_SPEED = 300 
 MIRROR_HANDLE_SIZE = 15 
+RAY_EPSILON = 1e-6  # 反射后忽略紧贴出射点的交点, 防止光线被同一面镜子重复命中
+RAY_MISS_LENGTH = 1000
+RAY_BOX_REACH = 4000  # 射出场景的光线在缓存中延伸的长度, 大于屏幕对角线
+SHAPE_TOLERANCE = 1.0  # 判断光线是否经过物体时的容差(像素), 吸收舍入误差
+DENSE_DEFAULT_RAYS = 1000
+DENSE_MIN_RAYS = 100
+DENSE_MAX_RAYS = 5000
+DENSE_FRAME_BUDGET_MS = 10.0  # 密集光束每次追踪+绘制允许占用的时间
+DENSE_BEAM_ALPHA = 160
+GRID_CELL_SIZE = 100  # 空间索引格子边长(像素)
+INDEX_MIN_OBJECTS = 12  # 场景物体少于该数时直接逐个检测, 不走空间索引
+PICK_HANDLE_RADIUS = 10
+PICK_CENTER_RADIUS = 20
+BATCH_MIN_RAYS = 16  # 光线数达到该值时改用 NumPy 批量追踪, 更少时逐条追踪反而更快
+TABLE_MIN_RAYS = 64  # 光线数达到该值时路径缓存改用 PathTable, 更少时 NumPy 的固定开销比省下的多
+SIM_STEP = 1 / 60  # 固定模拟步长(秒), 与渲染帧率无关
+MAX_FRAME_TIME = 0.25  # 单帧最多补算的时间, 卡顿后不会一口气补几百步
+TARGET_SPEED = 120  # 移动靶速度(像素/秒)
+EIGHT_SHAPE_SPEED = 3.0  # 8字形靶相位速度(弧度/秒)
+RAY_WIDTH = 3
+RAY_COLOR = (255, 200, 0)
+RAY_PULSE_STEP = 5  # 光线透明度按该步长变化, 变化时才重画光线区域
+SOLVER_GRID = 10  # 求解器放置镜子的坐标步长(像素)
+SOLVER_ANGLE_STEP = 15  # 求解器尝试的镜子角度步长(度)
+SOLVER_PATIENCE = 200  # 局部搜索连续这么多步没有改进就重新随机放置
+SOLVER_CHUNK_SECONDS = 0.5  # 工作进程每次搜索的时长, 找到解后其余进程最多再跑这么久
+SOLVER_COUNT_SECONDS = 5.0  # 每个镜子数默认的搜索时长
+GRADE_CHUNK = 500  # 批改作业时每个进程任务的份数
+GRADE_FIELDS = ('line', 'id', 'level', 'mirrors', 'hit', 'targets', 'completed', 'score', 'error')  # 报告的列
+BENCH_TARGET_SECONDS = 0.02  # 基准每轮至少运行这么久, 据此决定一轮调用几次
+BENCH_REPEAT = 5
+BENCH_REGRESSION = 1.2  # 对比时慢了超过这个倍数算性能回退
+PROFILE_WINDOW = 240  # 性能面板统计最近这么多帧
+PROFILE_HUD_INTERVAL = 250  # 性能面板文字刷新间隔(毫秒)
+PROFILE_MAX_EVENTS = 500000  # trace 文件最多记录的事件数, 防止长时间运行占满内存
+HEATMAP_CELL = 5  # 热力图网格边长(像素)
+HEATMAP_BATCH = 200  # 热力图第一帧追踪的光线数, 之后按耗时调整
+HEATMAP_BUDGET_MS = 4.0  # 热力图每帧允许占用的时间
+HEATMAP_MAX_RAYS = 200000  # 累计到这么多条光线后不再细化
+HEATMAP_REDRAW_MS = 100  # 热力图表面最多每隔这么久重画一次
+HEATMAP_ALPHA = 170
+FONT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.optics_lab_fonts.json')  # 字体名 -> 字体文件路径
+SERVER_PORT = 8765
+SERVER_TICK = 1 / 30  # 服务器每局推送状态的间隔(秒)
+LOAD_ACTION_INTERVAL = 0.25  # 压测客户端平均每隔这么久做一次操作(秒)
+REPLAY_MAGIC = b'OPTR'  # 录像文件头
+REPLAY_VERSION = 1
+# 录像记录的操作码就是在这个元组中的下标, 只能在末尾追加
+REPLAY_OPS = ('end', 'trace', 'add', 'remove', 'move', 'rotate', 'rays', 'spread', 'dense', 'beam_rays',
+              'clear', 'restart', 'next', 'release')
  
 # 颜色定义 
 WHITE = (255, 255, 255)
@@ -20,10 +85,164 @@ PURPLE = (128, 0, 128)
  
 # 窗口尺寸 
 WIDTH, HEIGHT = 1200, 800 
+LEVEL_COUNT = 5  # 内置关卡数
+LEVEL_CACHE_SIZE = 16  # 关卡包最多缓存这么多个解析好的关卡
+TOOLBAR_WIDTH = 150
+TEXT_CACHE_LIMIT = 256
+
+HINTS = [
+    "操作提示:",
+    "↑/↓: 增减光线数量",
+    "←/→: 调整光线角度",
+    "点击镜子端点: 旋转",
+    "拖动镜子: 移动位置",
+    "D: 删除镜子",
+    "C: 复制镜子",
+    "空格: 重置",
+    "N: 下一关",
+    "R: 重试当前关",
+    "B: 密集光束模式",
+    "H: 光照热力图",
+    "F3: 性能面板"
+]
+
+pygame = None  # 只在需要画面时导入, 无界面的模拟核心不依赖 pygame
+
+def load_pygame():
+    """导入 pygame; 任何绘图代码执行前都要先调用"""
+    global pygame
+    if pygame is None:
+        import pygame as module
+        pygame = module
+    return pygame
+
+class SimClock:
+    """模拟时钟: 只随 advance(dt) 前进, 与真实时间无关, 便于无界面地快速模拟"""
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def advance(self, dt):
+        self.time += dt
+
+    def ticks(self):
+        return int(self.time * 1000)
+
+class WallClock:
+    """真实时钟, ticks 与 pygame.time.get_ticks 一样返回启动以来的毫秒数"""
+    def __init__(self):
+        self.origin = time.perf_counter()
+
+    @property
+    def time(self):
+        return time.perf_counter() - self.origin
+
+    def ticks(self):
+        return int(self.time * 1000)
+
+WALL_CLOCK = WallClock()
+
+class Profiler:
+    """性能剖析: 各阶段耗时、追踪的光线数、求交次数和缓存命中
+
+    埋点写成 t = PROFILER.start() ... PROFILER.stop('阶段', t) 和 PROFILER.count('计数', n),
+    关闭时只多一次属性判断. 关闭时 start() 返回 None, stop() 遇到 None 就不记,
+    所以帧中途打开面板不会把半截阶段记成从 0 开始的巨大耗时. 打开后按帧累计, end_frame() 时存入最近 window 帧的样本,
+    供性能面板显示分位数. record_to(path) 还会记下每个阶段的起止时间,
+    dump() 写成 Chrome trace 格式 (chrome://tracing 或 Perfetto 打开).
+    """
+    TIMINGS = ('frame', 'step', 'events', 'trace', 'update_rays', 'trace_rays', 'heatmap', 'render', 'flip')
+    COUNTERS = ('rays', 'tests', 'ray_cache_hits', 'text_cache_hits')
+
+    def __init__(self, window=PROFILE_WINDOW):
+        self.enabled = False
+        self.hud = False
+        self.trace_path = None
+        self.origin = time.perf_counter()
+        self.current = {}  # 本帧累计
+        self.samples = {name: deque(maxlen=window) for name in self.TIMINGS + self.COUNTERS}
+        self.events = []
+        self.lines = []  # 性能面板上显示的文字
+        self.lines_time = None
+        self.lock = threading.Lock()  # 服务器和多光源追踪会在别的线程里记录
+
+    def set_hud(self, visible):
+        self.hud = visible
+        self.enabled = visible or self.trace_path is not None
+
+    def record_to(self, path):
+        self.trace_path = path
+        self.enabled = True
+
+    def start(self):
+        return time.perf_counter() if self.enabled else None
+
+    def stop(self, name, start):
+        if start is None or not self.enabled:
+            return
+        end = time.perf_counter()
+        with self.lock:
+            self.current[name] = self.current.get(name, 0.0) + (end - start) * 1000
+            if self.trace_path is not None and len(self.events) < PROFILE_MAX_EVENTS:
+                self.events.append((name, start, end))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.current[name] = self.current.get(name, 0) + n
+
+    def end_frame(self):
+        """把本帧的累计值存为样本; 本帧没出现的项记 0"""
+        if not self.enabled:
+            return
+        for name, samples in self.samples.items():
+            samples.append(self.current.get(name, 0))
+        if self.trace_path is not None and len(self.events) < PROFILE_MAX_EVENTS:
+            self.events.append(({name: self.current.get(name, 0) for name in self.COUNTERS}, time.perf_counter(), None))
+        self.current = {}
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        values = sorted(self.samples[name])
+        if not values:
+            return [0] * len(points)
+        return [values[round(p / 100 * (len(values) - 1))] for p in points]
+
+    def hud_lines(self, now):
+        """性能面板的文字, 每 PROFILE_HUD_INTERVAL 毫秒才重新统计, 避免面板每帧都重画"""
+        if self.lines_time is None or now - self.lines_time >= PROFILE_HUD_INTERVAL:
+            self.lines_time = now
+            frames = len(self.samples['frame'])
+            lines = [f"最近 {frames} 帧  p50 / p95 / p99"]
+            for name in self.TIMINGS:
+                lines.append("{}: {:.2f} / {:.2f} / {:.2f} ms".format(name, *self.percentiles(name)))
+            for name in self.COUNTERS:
+                lines.append("{}: {} / {} / {}".format(name, *self.percentiles(name)))
+            self.lines = lines
+        return self.lines
+
+    def dump(self):
+        """把记录的事件写成 Chrome trace 文件"""
+        trace = []
+        for name, start, end in self.events:
+            ts = (start - self.origin) * 1e6
+            if end is None:
+                trace.append({'name': 'counters', 'ph': 'C', 'ts': ts, 'pid': 0, 'tid': 0, 'args': name})
+            else:
+                trace.append({'name': name, 'ph': 'X', 'ts': ts, 'dur': (end - start) * 1e6, 'pid': 0, 'tid': 0})
+        with open(self.trace_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+PROFILER = Profiler()
  
 class OpticalDevice:
-    """光学器材基类"""
+    """光学器材基类
+
+    用 __slots__ 存放属性, 不带实例字典; 场景里镜子很多时省内存, 属性读取也更快.
+    """
+    __slots__ = ('scene', 'x', 'y', 'is_dragging', '_angle', '_needs_update', 'color', '_length', '_geometry')
+
     def __init__(self, x, y):
+        self.scene = None  # 接收变化通知的场景 (Simulation 或 SceneIndex) 
+        self._geometry = None 
         self.x = x 
         self.y = y 
         self.is_dragging     = False 
@@ -36,18 +255,55 @@ class OpticalDevice:
         if self.x != x or self.y != y:
             self.x = x 
             self.y = y 
+            self._geometry = None 
             self.needs_update     = True 
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        self._angle = value
+        self._geometry = None
+
+    @property
+    def length(self):
+        return self._length
+
+    @length.setter
+    def length(self, value):
+        self._length = value
+        self._geometry = None
+
+    @property
+    def needs_update(self):
+        return self._needs_update
+
+    @needs_update.setter
+    def needs_update(self, value):
+        # 移动或旋转都会置位 needs_update, 由此把变化通知给所在场景
+        self._needs_update = value
+        if value and self.scene is not None:
+            self.scene.mark_dirty(self)
  
 class Mirror(OpticalDevice):
-    """平面镜"""
-    def __init__(self, x, y, length=100):
+    """平面镜
+
+    两端点和单位法线在第一次用到时算好存下, 直到镜子移动或旋转才重算;
+    绘制、拾取和追踪每帧多次读取端点, 不必每次都算 cos/sin.
+    """
+    __slots__ = ('last_update', 'clock')
+
+    def __init__(self, x, y, length=100, clock=None):
         super().__init__(x, y)
         self.length    = length 
         self.last_update    = 0 
+        self.clock    = clock or WALL_CLOCK 
  
     def move(self, x, y):
         super().move(x, y)
-        self.last_update    = pygame.time.get_ticks()   
+        self.last_update    = self.clock.ticks()   
     
     def draw(self, surface):
         start, end = self.get_end_points()   
@@ -55,81 +311,518 @@ class Mirror(OpticalDevice):
         pygame.draw.circle(surface,    BLUE, (int(start[0]), int(start[1])), MIRROR_HANDLE_SIZE)
         pygame.draw.circle(surface,    RED, (int(end[0]), int(end[1])), MIRROR_HANDLE_SIZE)
  
+    def geometry(self):
+        """((起点, 终点), 单位法线)"""
+        if self._geometry is None:
+            dx = self.length/2    * math.cos(math.radians(self.angle))    
+            dy = self.length/2    * math.sin(math.radians(self.angle))    
+            ends = ((self.x - dx, self.y - dy), (self.x + dx, self.y + dy))
+            half = math.hypot(dx, dy) or 1
+            self._geometry = (ends, (-dy/half, dx/half))
+        return self._geometry
+
     def get_end_points(self):
-        dx = self.length/2    * math.cos(math.radians(self.angle))    
-        dy = self.length/2    * math.sin(math.radians(self.angle))    
-        return (
-            (self.x - dx, self.y - dy), 
-            (self.x + dx, self.y + dy)
-        )
+        return self.geometry()[0]
  
 class Target:
     """目标靶区域"""
+    kind = 'target'  # 关卡文件中的类型名
+    __slots__ = ('x', 'y', 'radius', 'hit', 'moved', 'prev_x', 'prev_y')
+
     def __init__(self, x, y, radius=30):
         self.x = x 
         self.y = y 
         self.radius    = radius 
         self.hit    = False 
         self.moved    = False 
+        self.prev_x    = x  # 上一模拟步的位置, 用于渲染插值 
+        self.prev_y    = y 
  
-    def draw(self, surface):
+    def position(self, alpha=1.0):
+        """上一步与当前位置之间按 alpha (0~1) 插值的位置"""
+        return (self.prev_x + (self.x - self.prev_x) * alpha,
+                self.prev_y + (self.y - self.prev_y) * alpha)
+
+    def track(self):
+        """运动轨道: (折线顶点, 当前在轨道上走过的路程); 静止或沿曲线运动的目标返回 None"""
+        return None
+
+    def draw(self, surface, alpha=1.0):
         color = GREEN if self.hit    else RED 
-        pygame.draw.circle(surface,    color, (self.x, self.y), self.radius)    
-        pygame.draw.circle(surface,    BLACK, (self.x, self.y), self.radius,    2)
+        pos = self.position(alpha)
+        pygame.draw.circle(surface,    color, pos, self.radius)    
+        pygame.draw.circle(surface,    BLACK, pos, self.radius,    2)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['x'], data['y'], data.get('radius', 30))
+
+    def to_dict(self):
+        return {'type': self.kind, 'x': self.x, 'y': self.y, 'radius': self.radius}
  
 class MovingTarget(Target):
     """水平移动目标"""
+    kind = 'moving'
+    __slots__ = ('min_x', 'max_x', 'speed', 'direction')
+
     def __init__(self, x, y, min_x, max_x):
         super().__init__(x, y)
         self.min_x    = min_x 
         self.max_x    = max_x 
-        self.speed    = 2 
+        self.speed    = TARGET_SPEED 
         self.direction    = 1 
         
-    def update(self):
-        prev_x = self.x 
-        self.x += self.speed    * self.direction    
-        self.moved    = (self.x != prev_x)
+    def update(self, dt):
+        self.prev_x, self.prev_y = self.x, self.y 
+        self.x += self.speed    * self.direction * dt 
         if self.x >= self.max_x    or self.x <= self.min_x:    
+            self.x = min(self.max_x, max(self.min_x, self.x))
             self.direction    *= -1 
+        self.moved    = (self.x != self.prev_x)
+
+    def track(self):
+        return [(self.min_x, self.y), (self.max_x, self.y)], self.x - self.min_x
+
+    @classmethod
+    def from_dict(cls, data):
+        target = cls(data['x'], data['y'], data['min_x'], data['max_x'])
+        target.radius = data.get('radius', 30)
+        target.speed = data.get('speed', TARGET_SPEED)
+        return target
+
+    def to_dict(self):
+        return dict(super().to_dict(), min_x=self.min_x, max_x=self.max_x, speed=self.speed)
  
 class VerticalMovingTarget(Target):
     """垂直移动目标"""
+    kind = 'vertical'
+    __slots__ = ('min_y', 'max_y', 'speed', 'direction')
+
     def __init__(self, x, y, min_y, max_y):
         super().__init__(x, y)
         self.min_y    = min_y 
         self.max_y    = max_y 
-        self.speed    = 2 
+        self.speed    = TARGET_SPEED 
         self.direction    = 1 
         
-    def update(self):
-        prev_y = self.y 
-        self.y += self.speed    * self.direction    
-        self.moved    = (self.y != prev_y)
+    def update(self, dt):
+        self.prev_x, self.prev_y = self.x, self.y 
+        self.y += self.speed    * self.direction * dt 
         if self.y >= self.max_y    or self.y <= self.min_y:    
+            self.y = min(self.max_y, max(self.min_y, self.y))
             self.direction    *= -1 
+        self.moved    = (self.y != self.prev_y)
+
+    def track(self):
+        return [(self.x, self.min_y), (self.x, self.max_y)], self.y - self.min_y
+
+    @classmethod
+    def from_dict(cls, data):
+        target = cls(data['x'], data['y'], data['min_y'], data['max_y'])
+        target.radius = data.get('radius', 30)
+        target.speed = data.get('speed', TARGET_SPEED)
+        return target
+
+    def to_dict(self):
+        return dict(super().to_dict(), min_y=self.min_y, max_y=self.max_y, speed=self.speed)
  
 class EightShapeTarget(Target):
-    """8字形移动靶"""
+    """8字形移动靶, 以 (x, y) 为中心"""
+    kind = 'eight'
+    __slots__ = ('cx', 'cy', 'timer', 'speed')
+
     def __init__(self, x, y):
         super().__init__(x, y)
+        self.cx    = x 
+        self.cy    = y 
         self.timer   = 0 
-        self.speed   = 0.05 
+        self.speed   = EIGHT_SHAPE_SPEED 
         
-    def update(self):
-        self.timer   += self.speed   
-        self.x = 800 + 200 * math.sin(self.timer   * 2)
-        self.y = 400 + 100 * math.sin(self.timer)  
+    def update(self, dt):
+        self.prev_x, self.prev_y = self.x, self.y 
+        self.timer   += self.speed * dt 
+        self.x = self.cx + 200 * math.sin(self.timer   * 2)
+        self.y = self.cy + 100 * math.sin(self.timer)  
         self.moved   = True 
+
+    @classmethod
+    def from_dict(cls, data):
+        target = cls(data['x'], data['y'])
+        target.radius = data.get('radius', 30)
+        target.speed = data.get('speed', EIGHT_SHAPE_SPEED)
+        return target
+
+    def to_dict(self):
+        return {'type': self.kind, 'x': self.cx, 'y': self.cy, 'radius': self.radius, 'speed': self.speed}
+
+class PathTarget(Target):
+    """沿折线路径匀速循环移动的目标, 走到最后一个点后直线回到起点"""
+    kind = 'path'
+    __slots__ = ('points', 'speed', 'distance', 'loop', 'lengths')
+
+    def __init__(self, points, speed=TARGET_SPEED, radius=30):
+        super().__init__(points[0][0], points[0][1], radius)
+        self.points    = [tuple(p) for p in points]
+        self.speed    = speed 
+        self.distance    = 0.0  # 从起点走过的路程 
+        self.loop    = self.points + self.points[:1]
+        self.lengths    = [0.0]  # 各顶点处的累计路程 
+        for a, b in zip(self.loop, self.loop[1:]):
+            self.lengths.append(self.lengths[-1] + math.dist(a, b))
+
+    def update(self, dt):
+        self.prev_x, self.prev_y = self.x, self.y 
+        total = self.lengths[-1]
+        if total > 0:
+            self.distance = (self.distance + self.speed * dt) % total
+            i = min(bisect.bisect_right(self.lengths, self.distance), len(self.loop) - 1) - 1
+            (x0, y0), (x1, y1) = self.loop[i], self.loop[i + 1]
+            segment = self.lengths[i + 1] - self.lengths[i]
+            f = (self.distance - self.lengths[i]) / segment if segment else 0.0
+            self.x = x0 + (x1 - x0) * f
+            self.y = y0 + (y1 - y0) * f
+        self.moved    = (self.x, self.y) != (self.prev_x, self.prev_y)
+
+    def track(self):
+        return self.loop, self.distance
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['points'], data.get('speed', TARGET_SPEED), data.get('radius', 30))
+
+    def to_dict(self):
+        return {'type': self.kind, 'points': [list(p) for p in self.points], 'speed': self.speed, 'radius': self.radius}
+
+MOVING_TARGETS = (MovingTarget, VerticalMovingTarget, EightShapeTarget, PathTarget)
+
+TARGET_TYPES = {cls.kind: cls for cls in (Target, MovingTarget, VerticalMovingTarget, EightShapeTarget, PathTarget)}
+
+def target_from_dict(data):
+    kind = data.get('type', Target.kind)
+    if kind not in TARGET_TYPES:
+        raise ValueError(f"未知的目标类型 {kind!r}")
+    return TARGET_TYPES[kind].from_dict(data)
  
 class Obstacle:
     """障碍物"""
+    __slots__ = ('rect',)
+
     def __init__(self, x, y, width, height):
-        self.rect   = pygame.Rect(x, y, width, height)
+        self.rect   = (x, y, width, height)
         
+    def box(self):
+        """轴对齐包围盒 (x0, y0, x1, y1)"""
+        x, y, w, h = self.rect
+        return (x, y, x + w, y + h)
+
     def draw(self, surface):
         pygame.draw.rect(surface,   BLACK, self.rect)  
  
+def ray_box_intersection(origin, direction, box):
+    """射线与轴对齐矩形 (x0, y0, x1, y1) 的 slab 求交, 返回进出参数 (t_enter, t_leave), 不相交返回 None"""
+    t_enter = -math.inf
+    t_leave = math.inf
+    for o, d, low, high in ((origin[0], direction[0], box[0], box[2]),
+                            (origin[1], direction[1], box[1], box[3])):
+        if d == 0:
+            if o < low or o > high:
+                return None
+            continue
+        t1 = (low - o) / d
+        t2 = (high - o) / d
+        if t1 > t2:
+            t1, t2 = t2, t1
+        t_enter = max(t_enter, t1)
+        t_leave = min(t_leave, t2)
+    if t_leave < max(t_enter, 0):
+        return None
+    return t_enter, t_leave
+
+class SpatialGrid:
+    """均匀网格空间索引
+
+    每个物体按包围盒登记到它覆盖的所有格子里; 物体移动时只改动它进出的格子, 不整体重建.
+    """
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}    # (cx, cy) -> {物体: 登记顺序}
+        self.entries = {}  # 物体 -> (包围盒, 格子列表, 登记顺序)
+        self.bounds = None  # 所有登记过的包围盒的并集, 只增不减
+        self.counter = 0
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def cell_range(self, box):
+        cs = self.cell_size
+        return (math.floor(box[0]/cs), math.floor(box[1]/cs),
+                math.floor(box[2]/cs), math.floor(box[3]/cs))
+
+    def cell_keys(self, box):
+        return box_cells(box, self.cell_size)
+
+    def insert(self, item, box):
+        order = self.counter
+        self.counter += 1
+        keys = self.cell_keys(box)
+        for key in keys:
+            self.cells.setdefault(key, {})[item] = order
+        self.entries[item] = (box, keys, order)
+        self.grow_bounds(box)
+
+    def remove(self, item):
+        box, keys, order = self.entries.pop(item)
+        for key in keys:
+            cell = self.cells[key]
+            del cell[item]
+            if not cell:
+                del self.cells[key]
+
+    def update(self, item, box):
+        old_box, old_keys, order = self.entries[item]
+        if box == old_box:
+            return
+        keys = self.cell_keys(box)
+        if keys != old_keys:
+            for key in old_keys:
+                cell = self.cells[key]
+                del cell[item]
+                if not cell:
+                    del self.cells[key]
+            for key in keys:
+                self.cells.setdefault(key, {})[item] = order
+        self.entries[item] = (box, keys, order)
+        self.grow_bounds(box)
+
+    def grow_bounds(self, box):
+        if self.bounds is None:
+            self.bounds = box
+        else:
+            b = self.bounds
+            self.bounds = (min(b[0], box[0]), min(b[1], box[1]), max(b[2], box[2]), max(b[3], box[3]))
+
+    def query_rect(self, box):
+        """包围盒与 box 重叠的物体, 按登记顺序排列"""
+        found = {}
+        for key in self.cell_keys(box):
+            for item, order in self.cells.get(key, {}).items():
+                b = self.entries[item][0]
+                if b[0] <= box[2] and box[0] <= b[2] and b[1] <= box[3] and box[1] <= b[3]:
+                    found[item] = order
+        return sorted(found, key=found.get)
+
+    def walk_ray(self, origin, direction):
+        """按射线经过的先后顺序遍历非空格子, 产出 (格内物体, 射线离开该格时的 t)"""
+        if self.bounds is None:
+            return
+        span = ray_box_intersection(origin, direction, self.bounds)
+        if span is None:
+            return
+        t_enter, t_leave = span
+        t = max(t_enter, 0.0)
+        ox, oy = origin
+        dx, dy = direction
+        cs = self.cell_size
+        cx0, cy0, cx1, cy1 = self.cell_range(self.bounds)
+        cx = min(max(math.floor((ox + dx*t)/cs), cx0), cx1)
+        cy = min(max(math.floor((oy + dy*t)/cs), cy0), cy1)
+
+        if dx > 0:
+            step_x, next_x, delta_x = 1, ((cx + 1)*cs - ox)/dx, cs/dx
+        elif dx < 0:
+            step_x, next_x, delta_x = -1, (cx*cs - ox)/dx, -cs/dx
+        else:
+            step_x, next_x, delta_x = 0, math.inf, math.inf
+        if dy > 0:
+            step_y, next_y, delta_y = 1, ((cy + 1)*cs - oy)/dy, cs/dy
+        elif dy < 0:
+            step_y, next_y, delta_y = -1, (cy*cs - oy)/dy, -cs/dy
+        else:
+            step_y, next_y, delta_y = 0, math.inf, math.inf
+
+        while True:
+            t_exit = min(next_x, next_y)
+            items = self.cells.get((cx, cy))
+            if items:
+                yield items, t_exit
+            if t_exit > t_leave:
+                return
+            if next_x < next_y:
+                cx += step_x
+                next_x += delta_x
+            else:
+                cy += step_y
+                next_y += delta_y
+
+class ArrayTable:
+    """一种物体的几何数据表: 每个物体一行, 按加入顺序连续存放在 (n, width) 数组里"""
+    def __init__(self, width, capacity=16):
+        self.items = []
+        self.rows = {}  # 物体 -> 行号
+        self.data = np.empty((capacity, width))
+
+    def __len__(self):
+        return len(self.items)
+
+    def view(self):
+        """有效的行, 不复制"""
+        return self.data[:len(self.items)]
+
+    def add(self, item, row):
+        n = len(self.items)
+        if n == len(self.data):
+            grown = np.empty((2 * n, self.data.shape[1]))
+            grown[:n] = self.data[:n]
+            self.data = grown
+        self.data[n] = row
+        self.rows[item] = n
+        self.items.append(item)
+
+    def set(self, item, row):
+        self.data[self.rows[item]] = row
+
+    def remove(self, item):
+        """删掉一行, 后面的行前移, 保持与场景列表相同的顺序"""
+        i = self.rows.pop(item)
+        n = len(self.items)
+        self.data[i:n - 1] = self.data[i + 1:n]
+        del self.items[i]
+        for j in range(i, n - 1):
+            self.rows[self.items[j]] = j
+
+def mirror_row(mirror):
+    """镜子在数组中的一行: 起点、边向量、单位法线"""
+    ((x1, y1), (x2, y2)), (nx, ny) = mirror.geometry()
+    return (x1, y1, x2 - x1, y2 - y1, nx, ny)
+
+class SceneArrays:
+    """场景几何的列式存储 (需要 NumPy)
+
+    镜子 (起点、边向量、法线)、目标 (圆心、半径) 和障碍物 (矩形) 各存一张 ArrayTable,
+    只在物体加入、移除、移动或旋转时改写它那一行. 批量追踪直接读这些数组, 不必每次从
+    物体逐个拼装; 行的顺序与加入顺序相同, 命中的目标下标可以直接对应回 targets 列表.
+    """
+    def __init__(self):
+        self.mirrors = ArrayTable(6)
+        self.targets = ArrayTable(3)
+        self.obstacles = ArrayTable(4)
+
+    def entry(self, item):
+        """物体所在的表和它的一行数据"""
+        if isinstance(item, Target):
+            return self.targets, (item.x, item.y, item.radius)
+        if isinstance(item, Obstacle):
+            return self.obstacles, item.box()
+        return self.mirrors, mirror_row(item)
+
+    def add(self, item):
+        table, row = self.entry(item)
+        table.add(item, row)
+
+    def remove(self, item):
+        self.entry(item)[0].remove(item)
+
+    def update(self, item):
+        table, row = self.entry(item)
+        table.set(item, row)
+
+    def matches(self, mirrors, targets, obstacles):
+        """表中的物体和顺序是否与这几个列表一致"""
+        return (self.mirrors.items == mirrors and self.targets.items == targets
+                and self.obstacles.items == obstacles)
+
+    def mirror_columns(self):
+        data = self.mirrors.view()
+        return data[:, 0:2], data[:, 2:4], data[:, 4:6]
+
+    def target_columns(self):
+        data = self.targets.view()
+        return data[:, 0:2], data[:, 2]
+
+class SceneIndex:
+    """场景空间索引: 镜子、目标和障碍物登记在 SpatialGrid 中, 供光线追踪和鼠标拾取只检测附近的物体
+
+    物体的增删和更新由使用者调用 add/remove/update, 在游戏中由 Simulation 负责;
+    镜子的 scene 指向索引时, 移动或旋转 (置位 needs_update) 会直接通知它.
+    """
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.grid = SpatialGrid(cell_size)
+        self.shapes = {}  # 物体 -> 登记时的形状, 镜子为两端点, 目标为 (x, y, r), 障碍物为矩形
+        self.arrays = SceneArrays() if np is not None else None  # 同样的物体按列存放, 供批量追踪
+
+    def __len__(self):
+        return len(self.grid.entries)
+
+    def __contains__(self, item):
+        return item in self.grid
+
+    @staticmethod
+    def shape_of(item):
+        if isinstance(item, Target):
+            return (item.x, item.y, item.radius)
+        if isinstance(item, Obstacle):
+            return item.box()
+        return item.get_end_points()
+
+    def bbox(self, item):
+        if isinstance(item, Target):
+            r = item.radius
+            return (item.x - r, item.y - r, item.x + r, item.y + r)
+        if isinstance(item, Obstacle):
+            return item.box()
+        (x1, y1), (x2, y2) = item.get_end_points()
+        return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+    def shape(self, item):
+        """物体最近一次登记或更新时的形状"""
+        return self.shapes[item]
+
+    def add(self, item):
+        self.grid.insert(item, self.bbox(item))
+        self.shapes[item] = self.shape_of(item)
+        if self.arrays is not None:
+            self.arrays.add(item)
+        if isinstance(item, OpticalDevice) and item.scene is None:
+            item.scene = self
+
+    def remove(self, item):
+        self.grid.remove(item)
+        del self.shapes[item]
+        if self.arrays is not None:
+            self.arrays.remove(item)
+        if isinstance(item, OpticalDevice) and item.scene is self:
+            item.scene = None
+
+    def update(self, item):
+        if item in self.grid:
+            self.grid.update(item, self.bbox(item))
+            self.shapes[item] = self.shape_of(item)
+            if self.arrays is not None:
+                self.arrays.update(item)
+
+    mark_dirty = update
+
+    def walk_ray(self, origin, direction):
+        return self.grid.walk_ray(origin, direction)
+
+    def devices_near(self, x, y, radius):
+        box = (x - radius, y - radius, x + radius, y + radius)
+        return [i for i in self.grid.query_rect(box) if isinstance(i, OpticalDevice)]
+
+def pick_device(devices, x, y, index=None):
+    """鼠标拾取: 返回 (镜子, 部位), 部位为 'start'/'end' 端点或 'center' 中心; 没点中返回 (None, None)"""
+    if index is not None:
+        devices = index.devices_near(x, y, max(PICK_HANDLE_RADIUS, PICK_CENTER_RADIUS))
+    for device in devices:
+        start, end = device.get_end_points()
+        if math.hypot(start[0] - x, start[1] - y) < PICK_HANDLE_RADIUS:
+            return device, 'start'
+        elif math.hypot(end[0] - x, end[1] - y) < PICK_HANDLE_RADIUS:
+            return device, 'end'
+        elif math.hypot(device.x - x, device.y - y) < PICK_CENTER_RADIUS:
+            return device, 'center'
+    return None, None
+
 class LightSource:
     """点光源"""
     def __init__(self, x, y):
@@ -138,98 +831,267 @@ class LightSource:
         self.rays    = []
         self.num_rays    = 3 
         self.spread    = 30 
-        self.prev_rays    = None 
         self.radius    = 10 
-        self.last_draw    = 0 
+        self.ray_surface    = None  # 画好所有光线的缓存表面, 光线变化前一直复用 
+        self.ray_rect    = None 
+        self.surface_version    = -1 
+        self.dense    = None  # DenseBeam, 开启密集光束模式时设置 
+        self.scene    = None 
+        self.paths    = PathList(0)  # 每条光线的路径缓存, 光线多时是 PathTable 
+        self.last_traced    = 0  # 最近一次 update_rays 实际追踪的光线数 
+        self.version    = 0  # 每次重新追踪后加一, 供绘制缓存判断光线是否变化 
+        self.rays_traced    = 0 
+        self.moving    = MovingHits(self)  # 移动目标只与缓存的路径求交 
+        self.hits    = set()  # 本光源照到的目标, 多个光源时由 GameLevel.apply_hits 合并 
  
-    def draw(self, surface):
-        now = pygame.time.get_ticks()   
-        if now - self.last_draw   < 50:  # 50ms间隔 
-            return 
-        self.last_draw   = now 
-        for ray in self.rays:   
-            if len(ray) >= 2:
-                width = 3 + math.sin(now/300)   * 1 
-                alpha = 200 + math.sin(now/400)   * 55 
-                color = (255, min(255, alpha), 0)
-                int_points = [(int(x),int(y)) for x,y in ray]
-                pygame.draw.lines(surface,   color, False, int_points, int(width))
- 
-    def update_rays(self, devices, targets):
-        active_devices = [d for d in devices if abs(d.x - self.x) < WIDTH/2]
-        targets_moved = any(isinstance(t, (MovingTarget, EightShapeTarget)) and t.moved   for t in targets)
-        needs_update = any(device.needs_update   for device in devices) or targets_moved 
-        
-        if not needs_update and self.prev_rays   is not None:
-            self.rays   = self.prev_rays    
-            return 
-            
-        for device in devices:
-            device.needs_update   = False 
+    def changed(self):
+        """光源参数改变, 所有光线都要重新追踪"""
+        if self.scene is not None:
+            self.scene.mark_dirty()
  
-        for target in targets:
-            target.hit   = False 
+    def set_dense(self, enabled):
+        """开关密集光束模式 (需要 NumPy)"""
+        if enabled and np is None:
+            return False
+        self.dense = DenseBeam(self) if enabled else None
+        self.changed()
+        return enabled
+
+    def draw(self, surface, now=None):
+        if self.dense is not None:
+            self.dense.draw(surface)
+            return
+        if now is None:
+            now = pygame.time.get_ticks()   
+        layer = self.ray_layer()
+        if layer is not None:
+            layer.set_alpha(self.pulse_alpha(now))
+            surface.blit(layer, (0, 0))
+
+    def pulse_alpha(self, now):
+        """光线在 now 时刻的脉动透明度"""
+        alpha = 200 + math.sin(now/RAY_PULSE_SPEED)   * 55 
+        return int(alpha) // RAY_PULSE_STEP * RAY_PULSE_STEP
+
+    def ray_layer(self):
+        """返回画好当前光线的表面, 只在重新追踪后重画一次; 没有光线时返回 None"""
+        if self.surface_version != self.version:
+            self.surface_version = self.version
+            self.ray_surface = None
+            self.ray_rect = None
+            rays = [[(int(x), int(y)) for x, y in ray] for ray in self.rays if len(ray) >= 2]
+            if rays:
+                layer = pygame.Surface((WIDTH, HEIGHT))
+                layer.set_colorkey(BLACK)
+                # draw.lines 返回画到的区域, 合并起来比 get_bounding_rect 扫描整张表面快得多
+                rects = [pygame.draw.lines(layer,   RAY_COLOR, False, points, RAY_WIDTH) for points in rays]
+                self.ray_surface = layer
+                self.ray_rect = rects[0].unionall(rects[1:])
+        return self.ray_surface
  
-        self.rays   = []
-        for i in range(self.num_rays):   
-            angle = self.spread/2   - i*(self.spread/(self.num_rays-1   or 1))
-            ray_path = self.trace_ray((self.x,   self.y), math.radians(angle),   devices, targets)
-            self.rays.append(ray_path)   
-        
-        self.prev_rays   = self.rays.copy()  
+    def update_rays(self, devices, targets, index=None, changes=None):
+        """重新追踪光线
+
+        changes 为 None 时全部重算; 否则是 (物体, 旧形状, 新形状) 的列表, 只重算缓存路径经过
+        这些物体旧位置或新位置的光线, 其余光线和它们的命中结果保持不变.
+        是否需要调用由场景的脏标记决定.
+        """
+        started = PROFILER.start()
+        if self.dense is not None:
+            for target in targets:
+                target.hit = False
+            self.rays = []
+            self.paths = PathList(0)
+            self.hits = self.dense.trace(devices, targets, index)
+            self.version += 1
+            self.last_traced = self.dense.active_rays
+            self.rays_traced += self.last_traced
+            PROFILER.count('rays', self.last_traced)
+            PROFILER.stop('update_rays', started)
+            return
+
+        angles, todo = self.plan_rays(changes)
+        if self.batch_todo(todo):
+            mirrors = [d for d in devices if isinstance(d, Mirror)]
+            obstacles = [d for d in devices if isinstance(d, Obstacle)]
+            rays = self.paths.trace(todo, (self.x, self.y), [angles[i] for i in todo], mirrors, targets, obstacles,
+                                    scene_arrays(index, mirrors, targets, obstacles))
+        else:
+            rays = self.trace_todo(angles, todo, devices, targets, index)
+        self.store_rays(angles, todo, rays, targets)
+        PROFILER.stop('update_rays', started)
+
+    def plan_rays(self, changes=None):
+        """本次要重新追踪哪些光线: 返回 (全部出射角, 光线下标); changes 为 None 时全部重算并换一个空缓存
+
+        有 NumPy 且光线数达到 TABLE_MIN_RAYS 时缓存用 PathTable, 否则用 PathList.
+        """
+        angles = self.ray_angles()
+        if changes is None or len(self.paths) != len(angles):
+            self.rays = [[] for _ in angles]
+            self.paths = (PathTable if np is not None and len(angles) >= TABLE_MIN_RAYS else PathList)(len(angles))
+            return angles, list(range(len(angles)))
+        return angles, sorted(self.paths.affected(changes))
+
+    def batch_todo(self, todo):
+        """todo 是否整批交给 PathTable.trace: 批量追踪并直接写入数组缓存, 不碰光源的其他状态"""
+        return isinstance(self.paths, PathTable) and len(todo) >= BATCH_MIN_RAYS
+
+    def trace_todo(self, angles, todo, devices, targets, index=None):
+        """逐条追踪 todo 中的光线并存入路径缓存, 返回它们裁剪后的显示路径"""
+        starts = [(self.x, self.y)] * len(todo)
+        return self.paths.store(todo, self.trace_rays_raw(starts, [angles[i] for i in todo], devices, targets,
+                                                          index=index))
+
+    def store_rays(self, angles, todo, rays, targets):
+        """换上 todo 中各光线新的显示路径 (缓存已由 PathTable.trace 或 trace_todo 写好), 并更新目标的命中状态"""
+        for i, ray in zip(todo, rays):
+            self.rays[i] = ray
+        self.version += 1
+        self.hits = {target for target in self.paths.targets if target is not None}
+        for target in targets:
+            target.hit = target in self.hits
+        self.last_traced = len(todo)
+        self.rays_traced += len(todo)
+        PROFILER.count('rays', len(todo))
+        PROFILER.count('ray_cache_hits', len(angles) - len(todo))
  
-    def trace_ray(self, start, angle, devices, targets, max_bounces=5):
+    def ray_angles(self):
+        """扇形光束中每条光线的出射角(弧度)"""
+        step = self.spread/(self.num_rays-1 or 1)
+        return [math.radians(self.spread/2 - i*step) for i in range(self.num_rays)]
+
+    def trace_rays(self, starts, angles, devices, targets, max_bounces=MAX_BOUNCES, index=None):
+        """追踪一组光线; 光线较多且有 NumPy 时走批量路径, 结果与 trace_ray 一致"""
+        paths = []
+        for path, target, missed in self.trace_rays_raw(starts, angles, devices, targets, max_bounces, index):
+            if target is not None:
+                target.hit = True
+            paths.append(clip_path(path))
+        return paths
+
+    def trace_rays_raw(self, starts, angles, devices, targets, max_bounces=MAX_BOUNCES, index=None):
+        """同 trace_rays, 但返回未裁剪的 (路径, 命中的目标, 是否射出场景) 且不修改目标状态
+
+        devices 中除了镜子还可以有障碍物, 光线碰到障碍物即被挡住.
+        """
+        started = PROFILER.start()
+        if np is None or len(angles) < BATCH_MIN_RAYS:
+            if index is not None and len(index) < INDEX_MIN_OBJECTS:
+                index = None
+            results = [self.trace_ray_raw(start, angle, devices, targets, max_bounces, index)
+                       for start, angle in zip(starts, angles)]
+            PROFILER.stop('trace_rays', started)
+            return results
+        mirrors = [d for d in devices if isinstance(d, Mirror)]
+        obstacles = [d for d in devices if isinstance(d, Obstacle)]
+        results = batch_results(trace_batch_arrays(starts, angles, mirrors, targets, max_bounces, obstacles,
+                                                   scene_arrays(index, mirrors, targets, obstacles)), targets)
+        PROFILER.stop('trace_rays', started)
+        return results
+
+    def trace_ray(self, start, angle, devices, targets, max_bounces=MAX_BOUNCES, index=None):
+        path, target, missed = self.trace_ray_raw(start, angle, devices, targets, max_bounces, index)
+        if target is not None:
+            target.hit = True
+        return clip_path(path)
+
+    def trace_ray_raw(self, start, angle, devices, targets, max_bounces=MAX_BOUNCES, index=None):
+        """追踪一条光线, 返回未裁剪的路径、命中的目标和光线是否最终射出场景"""
         path = [start]
         current_pos = start 
         direction = (math.cos(angle),   math.sin(angle))   
         
         for _ in range(max_bounces):
-            closest_t = float('inf')
-            closest_device = None 
-            intersect_point = None 
-            closest_target = None 
-            normal = None 
- 
-            # 先检测目标碰撞 
-            for target in targets:
-                result = self.target_intersection(current_pos,   direction, target)
-                if result and result['t'] < closest_t:
-                    closest_t = result['t']
-                    closest_target = target 
-                    intersect_point = result['point']
- 
-            # 再检测设备碰撞 
-            for device in devices:
-                if isinstance(device, Mirror):
-                    result = self.mirror_intersection(current_pos,   direction, device)
-                    if result and result['t'] < closest_t:
-                        closest_t = result['t']
-                        closest_device = device 
-                        intersect_point = result['point']
-                        normal = result['normal']
+            if index is None:
+                hit = self.closest_hit(current_pos, direction, devices, targets)
+            else:
+                hit = self.closest_hit_indexed(current_pos, direction, index)
+            closest_t, closest_target, closest_device, intersect_point, normal = hit
  
             # 优先处理目标命中 
             if closest_target:
-                closest_target.hit   = True 
                 path.append(intersect_point)  
-                break 
+                return path, closest_target, False
+
+            if isinstance(closest_device, Obstacle):
+                path.append(intersect_point)
+                return path, None, False
  
             if not closest_device:
-                end_x = current_pos[0] + direction[0] * 1000 
-                end_y = current_pos[1] + direction[1] * 1000 
+                end_x = current_pos[0] + direction[0] * RAY_MISS_LENGTH 
+                end_y = current_pos[1] + direction[1] * RAY_MISS_LENGTH 
                 path.append((end_x,   end_y))
-                break 
+                return path, None, True
  
             if intersect_point:
                 path.append(intersect_point)   
                 current_pos = intersect_point 
                 direction = self.reflect(direction,   normal)
             
-        valid_path = [p for p in path if all(not math.isnan(c)   for c in p)]
-        return [p for p in valid_path if 0 <= p[0] <= WIDTH and 0 <= p[1] <= HEIGHT]
+        return path, None, False
+
+    def closest_hit(self, origin, direction, devices, targets):
+        """射线最先碰到的物体: 返回 (t, 目标, 镜子, 交点, 法线), 什么都没碰到时 t 为 inf"""
+        closest_t = float('inf')
+        closest_device = None 
+        intersect_point = None 
+        closest_target = None 
+        normal = None 
+        if PROFILER.enabled:
+            PROFILER.count('tests', len(targets) + len(devices))
+ 
+        # 先检测目标碰撞 
+        for target in targets:
+            result = self.target_intersection(origin, direction, target)
+            if result and result['t'] < closest_t:
+                closest_t = result['t']
+                closest_target = target 
+                intersect_point = result['point']
+ 
+        # 再检测设备碰撞 
+        for device in devices:
+            if isinstance(device, Mirror):
+                result = self.mirror_intersection(origin, direction, device)
+                if result and result['t'] < closest_t:
+                    closest_t = result['t']
+                    closest_target = None  # 镜子挡在目标之前 
+                    closest_device = device 
+                    intersect_point = result['point']
+                    normal = result['normal']
+
+        # 最后检测障碍物, 光线在进入点被挡住 
+        for device in devices:
+            if isinstance(device, Obstacle):
+                result = ray_box_intersection(origin, direction, device.box())
+                if result and max(result[0], 0) < closest_t:
+                    closest_t = max(result[0], 0)
+                    closest_target = None 
+                    closest_device = device 
+                    intersect_point = (origin[0] + direction[0]*closest_t, origin[1] + direction[1]*closest_t)
+                    normal = None 
+
+        return closest_t, closest_target, closest_device, intersect_point, normal
+
+    def closest_hit_indexed(self, origin, direction, index):
+        """与 closest_hit 相同, 但只检测射线沿途格子里的物体, 找到当前格内的交点即停止"""
+        best = (float('inf'), None, None, None, None)
+        seen = set()
+        for items, t_exit in index.walk_ray(origin, direction):
+            fresh = [item for item in items if item not in seen]
+            if fresh:
+                seen.update(fresh)
+                targets = [item for item in fresh if isinstance(item, Target)]
+                devices = [item for item in fresh if not isinstance(item, Target)]
+                hit = self.closest_hit(origin, direction, devices, targets)
+                if hit[0] < best[0]:
+                    best = hit
+            if best[0] <= t_exit:
+                break
+        return best
  
     def mirror_intersection(self, origin, direction, mirror):
-        start, end = mirror.get_end_points()   
+        (start, end), normal = mirror.geometry()   
         x1, y1 = start 
         x2, y2 = end 
         x3, y3 = origin 
@@ -242,17 +1104,12 @@ class LightSource:
         t = ((x1-x3)*(y2-y1) - (y1-y3)*(x2-x1)) / denominator 
         u = ((x1-x3)*dy - (y1-y3)*dx) / denominator 
         
-        if t < 0 or u < 0 or u > 1:
+        if t < RAY_EPSILON or u < 0 or u > 1:
             return None 
  
         px = x3 + t*dx 
         py = y3 + t*dy 
         
-        mirror_dir = (x2 - x1, y2 - y1)
-        normal = (-mirror_dir[1], mirror_dir[0])
-        length = math.hypot(*normal)   
-        normal = (normal[0]/length, normal[1]/length)
-        
         return {'t': t, 'point': (px, py), 'normal': normal}
  
     def target_intersection(self, origin, direction, target):
@@ -286,17 +1143,826 @@ class LightSource:
         return (direction[0] - 2*dot*normal[0],
                 direction[1] - 2*dot*normal[1])
  
+def batch_results(traced, targets):
+    """把 trace_batch_arrays 的数组结果转成与 trace_ray_raw 相同的 [(路径, 命中的目标, 是否射出场景)]"""
+    points, lengths, hits, missed = traced
+    coords = points.transpose(1, 0, 2).tolist()
+    return [([tuple(p) for p in coords[i][:lengths[i]]], targets[hit] if hit >= 0 else None, miss)
+            for i, (hit, miss) in enumerate(zip(hits.tolist(), missed.tolist()))]
+
+def clip_path(path):
+    """去掉路径中的无效点和屏幕外的点"""
+    valid_path = [p for p in path if all(not math.isnan(c) for c in p)]
+    return [p for p in valid_path if 0 <= p[0] <= WIDTH and 0 <= p[1] <= HEIGHT]
+
+def boxes_overlap(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def box_cells(box, cell_size):
+    """包围盒覆盖的所有网格格子"""
+    cx0, cy0 = math.floor(box[0]/cell_size), math.floor(box[1]/cell_size)
+    cx1, cy1 = math.floor(box[2]/cell_size), math.floor(box[3]/cell_size)
+    return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+
+def segment_cells(p0, p1, cell_size):
+    """线段依次经过的网格格子"""
+    (x0, y0), (x1, y1) = p0, p1
+    cx, cy = math.floor(x0/cell_size), math.floor(y0/cell_size)
+    steps = abs(math.floor(x1/cell_size) - cx) + abs(math.floor(y1/cell_size) - cy)
+    dx, dy = x1 - x0, y1 - y0
+    if dx:
+        step_x = 1 if dx > 0 else -1
+        next_x = ((cx + (dx > 0))*cell_size - x0) / dx
+        delta_x = cell_size / abs(dx)
+    else:
+        step_x, next_x, delta_x = 0, math.inf, math.inf
+    if dy:
+        step_y = 1 if dy > 0 else -1
+        next_y = ((cy + (dy > 0))*cell_size - y0) / dy
+        delta_y = cell_size / abs(dy)
+    else:
+        step_y, next_y, delta_y = 0, math.inf, math.inf
+    cells = [(cx, cy)]
+    for _ in range(steps):
+        if next_x < next_y:
+            cx += step_x
+            next_x += delta_x
+        else:
+            cy += step_y
+            next_y += delta_y
+        cells.append((cx, cy))
+    return cells
+
+def point_segment_distance(p, a, b):
+    ax, ay = a
+    ex, ey = b[0] - ax, b[1] - ay
+    length2 = ex*ex + ey*ey
+    u = 0.0 if length2 == 0 else max(0.0, min(1.0, ((p[0] - ax)*ex + (p[1] - ay)*ey) / length2))
+    return math.hypot(ax + u*ex - p[0], ay + u*ey - p[1])
+
+def segments_distance(a0, a1, b0, b1):
+    """两条线段之间的最短距离, 相交时为 0"""
+    def cross(o, p, q):
+        return (p[0] - o[0])*(q[1] - o[1]) - (p[1] - o[1])*(q[0] - o[0])
+    d1, d2 = cross(b0, b1, a0), cross(b0, b1, a1)
+    d3, d4 = cross(a0, a1, b0), cross(a0, a1, b1)
+    if ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0)):
+        return 0.0
+    return min(point_segment_distance(a0, b0, b1), point_segment_distance(a1, b0, b1),
+               point_segment_distance(b0, a0, a1), point_segment_distance(b1, a0, a1))
+
+def shape_box(shape):
+    """镜子线段 ((x1, y1), (x2, y2))、目标圆 (x, y, r) 或障碍物矩形 (x0, y0, x1, y1) 的包围盒, 外扩 SHAPE_TOLERANCE"""
+    pad = SHAPE_TOLERANCE
+    if len(shape) == 3:
+        x, y, r = shape
+        return (x - r - pad, y - r - pad, x + r + pad, y + r + pad)
+    if len(shape) == 4:
+        x0, y0, x1, y1 = shape
+        return (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+    (x1, y1), (x2, y2) = shape
+    return (min(x1, x2) - pad, min(y1, y2) - pad, max(x1, x2) + pad, max(y1, y2) + pad)
+
+class RayPath:
+    """单条光线的缓存
+
+    除了未裁剪的路径和命中的目标, 还记下判断它是否受场景变化影响所需的几何信息:
+    每一段的包围盒, 以及各段经过的网格格子 (cell_size 为 None 时不算, PathTable 不用网格).
+    射出场景的光线把最后一段延长到屏幕外, 以覆盖 trace_ray 实际检测过的整条射线.
+    """
+    __slots__ = ('path', 'target', 'segments', 'boxes', 'cells')
+
+    def __init__(self, path, target, missed, cell_size=GRID_CELL_SIZE):
+        self.path = path
+        self.target = target
+        self.segments = list(zip(path, path[1:]))
+        if missed and self.segments:
+            (x0, y0), (x1, y1) = self.segments[-1]
+            scale = RAY_BOX_REACH / (math.hypot(x1 - x0, y1 - y0) or 1)
+            self.segments[-1] = ((x0, y0), (x1 + (x1 - x0)*scale, y1 + (y1 - y0)*scale))
+        self.boxes = [shape_box(segment) for segment in self.segments]
+        self.cells = set()
+        if cell_size is not None:
+            for p0, p1 in self.segments:
+                self.cells.update(segment_cells(p0, p1, cell_size))
+
+    def crosses(self, shape):
+        """路径是否经过 (或贴近) 一面镜子、一个目标或一个障碍物"""
+        box = shape_box(shape)
+        return any(boxes_overlap(seg_box, box) and segment_crosses(p0, p1, shape, box)
+                   for (p0, p1), seg_box in zip(self.segments, self.boxes))
+
+EMPTY_BOX = (math.inf, math.inf, -math.inf, -math.inf)  # 与任何包围盒都不重叠
+
+def segment_crosses(p0, p1, shape, box):
+    """线段 p0p1 是否经过 (或贴近) 物体形状 shape; box 为 shape_box(shape)"""
+    if len(shape) == 4:
+        hit = ray_box_intersection(p0, (p1[0] - p0[0], p1[1] - p0[1]), box)
+        return bool(hit) and hit[0] <= 1
+    if len(shape) == 3:
+        return point_segment_distance(shape[:2], p0, p1) <= shape[2] + SHAPE_TOLERANCE
+    return segments_distance(p0, p1, shape[0], shape[1]) <= SHAPE_TOLERANCE
+
+class PathList:
+    """一个光源的路径缓存: 每条光线一个 RayPath, 另记网格格子 -> 经过该格的光线下标
+
+    光线少或没有 NumPy 时使用, 与 PathTable 接口相同. 按下标取出的是 RayPath.
+    """
+    def __init__(self, n):
+        self.records = [None] * n
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    @property
+    def targets(self):
+        """每条光线命中的目标 (没有时为 None)"""
+        return [record.target for record in self.records]
+
+    def store(self, rows, results):
+        """写入逐条追踪的结果 [(路径, 命中的目标, 是否射出场景)], 返回它们裁剪后的显示路径"""
+        rays = []
+        for i, (path, target, missed) in zip(rows, results):
+            if self.records[i] is not None:
+                for cell in self.records[i].cells:
+                    self.cells[cell].discard(i)
+            record = RayPath(path, target, missed)
+            for cell in record.cells:
+                self.cells.setdefault(cell, set()).add(i)
+            self.records[i] = record
+            rays.append(clip_path(path))
+        return rays
+
+    def affected(self, changes):
+        """缓存路径经过变化物体旧位置或新位置的光线下标"""
+        affected = set()
+        for item, old, new in changes:
+            for shape in (old, new):
+                if shape is None:
+                    continue
+                candidates = set()
+                for cell in box_cells(shape_box(shape), GRID_CELL_SIZE):
+                    candidates.update(self.cells.get(cell, ()))
+                for i in candidates - affected:
+                    if self.records[i].crosses(shape):
+                        affected.add(i)
+        return affected
+
+class PathTable:
+    """光线多时的路径缓存 (需要 NumPy), 与 PathList 接口相同: 各光线的路径、线段和包围盒存成数组
+
+    批量追踪的结果由 trace 直接从 trace_batch_arrays 的数组整体算出线段和包围盒, 不为每条光线
+    构造 RayPath、也不登记网格格子, 连同追踪本身都可以放进线程池. 判断哪些光线受变化影响时先对
+    全部线段做一次向量化的包围盒筛选, 再对筛出的少数线段精确判断. 按下标取 RayPath 时才构造.
+    """
+    def __init__(self, n, max_bounces=MAX_BOUNCES):
+        self.points = np.full((n, max_bounces + 1, 2), np.nan)  # 未裁剪的路径
+        self.lengths = np.zeros(n, dtype=int)
+        self.missed = np.zeros(n, dtype=bool)
+        self.segments = np.full((n, max_bounces, 4), np.nan)  # 各段 (x0, y0, x1, y1), 射出场景的最后一段已延长
+        self.boxes = np.empty((n, max_bounces, 4))  # 各段外扩 SHAPE_TOLERANCE 的包围盒, 不存在的段永不重叠
+        self.boxes[:] = EMPTY_BOX
+        self.targets = [None] * n
+        self.records = [None] * n  # 按需构造的 RayPath, 光线重算后作废
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, i):
+        if self.records[i] is None:
+            path = [tuple(p) for p in self.points[i, :self.lengths[i]].tolist()]
+            self.records[i] = RayPath(path, self.targets[i], bool(self.missed[i]), cell_size=None)
+        return self.records[i]
+
+    def __iter__(self):
+        for i, record in enumerate(self.records):
+            if record is None:
+                self[i]
+        return iter(self.records)
+
+    def trace(self, rows, start, angles, mirrors, targets, obstacles=(), arrays=None):
+        """从 start 按 angles 批量追踪 rows 中的光线并写入表, 返回它们裁剪后的显示路径
+
+        只读写这张表, 可以放进线程池与其他光源同时执行.
+        """
+        started = PROFILER.start()
+        points, lengths, hits, missed = trace_batch_arrays(start, angles, mirrors, targets,
+                                                           self.points.shape[1] - 1, obstacles, arrays)
+        rays = self.write(rows, points.transpose(1, 0, 2), lengths, missed,
+                          [targets[hit] if hit >= 0 else None for hit in hits.tolist()])
+        PROFILER.stop('trace_rays', started)
+        return rays
+
+    def store(self, rows, results):
+        """写入逐条追踪的结果 [(路径, 命中的目标, 是否射出场景)], 返回它们裁剪后的显示路径
+
+        逐条追踪的只是少数光线, 直接把构造好的 RayPath 逐行填进表里, 比整批的数组运算快.
+        """
+        rays = []
+        for i, (path, target, missed) in zip(rows, results):
+            record = RayPath(path, target, missed, cell_size=None)
+            count = len(record.segments)
+            self.points[i] = np.nan
+            self.points[i, :len(path)] = path
+            self.lengths[i] = len(path)
+            self.missed[i] = missed
+            self.segments[i] = np.nan
+            self.boxes[i] = EMPTY_BOX
+            if count:
+                self.segments[i, :count] = [p0 + p1 for p0, p1 in record.segments]
+                self.boxes[i, :count] = record.boxes
+            self.targets[i] = target
+            self.records[i] = record
+            rays.append(clip_path(path))
+        return rays
+
+    def write(self, rows, points, lengths, missed, targets):
+        """写入批量追踪的 rows 中各光线的路径 points (k, 点数, 2) 等, 整批算出线段和包围盒, 返回裁剪后的显示路径"""
+        rows = np.asarray(rows, dtype=int)
+        lengths = np.asarray(lengths, dtype=int)
+        missed = np.asarray(missed, dtype=bool)
+        self.points[rows] = points
+        self.lengths[rows] = lengths
+        self.missed[rows] = missed
+        p0, p1 = points[:, :-1], points[:, 1:].copy()
+        # 与 RayPath 相同: 射出场景的光线把最后一段延长 RAY_BOX_REACH
+        ext = np.flatnonzero(missed & (lengths >= 2))
+        if ext.size:
+            last = lengths[ext] - 2
+            a, b = p0[ext, last], p1[ext, last]
+            length = np.hypot(b[:, 0] - a[:, 0], b[:, 1] - a[:, 1])
+            scale = RAY_BOX_REACH / np.where(length == 0, 1, length)
+            p1[ext, last] = b + (b - a) * scale[:, None]
+        valid = np.arange(p0.shape[1]) < (lengths - 1)[:, None]
+        segments = np.concatenate([p0, p1], axis=2)
+        segments[~valid] = np.nan
+        boxes = np.concatenate([np.fmin(p0, p1) - SHAPE_TOLERANCE, np.fmax(p0, p1) + SHAPE_TOLERANCE], axis=2)
+        boxes[~valid] = EMPTY_BOX
+        self.segments[rows] = segments
+        self.boxes[rows] = boxes
+        for i, target in zip(rows.tolist(), targets):
+            self.targets[i] = target
+            self.records[i] = None
+        # 与 clip_path 相同: 去掉无效点和屏幕外的点 (NaN 的比较都不成立)
+        x, y = points[..., 0], points[..., 1]
+        keep = (x >= 0) & (x <= WIDTH) & (y >= 0) & (y <= HEIGHT)
+        return [[tuple(p) for p, k in zip(path, flags) if k] for path, flags in zip(points.tolist(), keep.tolist())]
+
+    def affected(self, changes):
+        """缓存路径经过变化物体旧位置或新位置的光线下标"""
+        shapes = [shape for _, old, new in changes for shape in (old, new) if shape is not None]
+        if not shapes:
+            return set()
+        shape_boxes = [shape_box(shape) for shape in shapes]
+        # 所有形状一次与所有线段比较包围盒, 得到 (光线, 段, 形状) 三元组
+        boxes = np.array(shape_boxes)
+        b = self.boxes[..., None, :]
+        rows, cols, which = np.nonzero((b[..., 0] <= boxes[:, 2]) & (boxes[:, 0] <= b[..., 2]) &
+                                       (b[..., 1] <= boxes[:, 3]) & (boxes[:, 1] <= b[..., 3]))
+        # 包围盒重叠的线段里, 所在直线从形状包围盒旁边经过 (四个角在同一侧) 的也排除掉;
+        # 射出场景的光线最后一段很长, 包围盒几乎与什么都重叠, 靠这一步筛掉
+        x0, y0, x1, y1 = self.segments[rows, cols].T
+        dx, dy = x1 - x0, y1 - y0
+        boxes = boxes[which]
+        side = np.stack([dx*(boxes[:, cy] - y0) - dy*(boxes[:, cx] - x0) for cx in (0, 2) for cy in (1, 3)])
+        near = (side.min(axis=0, initial=math.inf) <= 0) & (side.max(axis=0, initial=-math.inf) >= 0)
+        affected = set()
+        for i, j, k in zip(rows[near].tolist(), cols[near].tolist(), which[near].tolist()):
+            if i not in affected:
+                x0, y0, x1, y1 = self.segments[i, j].tolist()
+                if segment_crosses((x0, y0), (x1, y1), shapes[k], shape_boxes[k]):
+                    affected.add(i)
+        return affected
+
+def linear_interval(value, slope, low, high):
+    """一次函数 value + slope*s 落在 [low, high] 内的 s 区间, 可能为空 (下界大于上界)"""
+    if slope == 0:
+        return (-math.inf, math.inf) if low <= value <= high else (math.inf, -math.inf)
+    s0, s1 = (low - value) / slope, (high - value) / slope
+    return (s0, s1) if s0 <= s1 else (s1, s0)
+
+def track_window(a, u, length, p0, p1, r):
+    """点 a + s*u (u 为单位向量, 0 ≤ s ≤ length) 离线段 p0p1 不超过 r 的 s 区间, 没有时返回 None
+
+    线段外扩 r 是一个胶囊形, 凸集与直线的交是一个区间, 等于两端圆和中间矩形各自区间的并.
+    """
+    lo, hi = math.inf, -math.inf
+    for cx, cy in (p0, p1):
+        fx, fy = a[0] - cx, a[1] - cy
+        b = fx*u[0] + fy*u[1]
+        disc = b*b - (fx*fx + fy*fy - r*r)
+        if disc >= 0:
+            root = math.sqrt(disc)
+            lo, hi = min(lo, -b - root), max(hi, -b + root)
+    ex, ey = p1[0] - p0[0], p1[1] - p0[1]
+    seg_len = math.hypot(ex, ey)
+    if seg_len > 0:
+        ex, ey = ex/seg_len, ey/seg_len
+        fx, fy = a[0] - p0[0], a[1] - p0[1]
+        # 沿线段方向的投影在 [0, seg_len] 内, 且到线段所在直线的距离不超过 r
+        along = linear_interval(fx*ex + fy*ey, u[0]*ex + u[1]*ey, 0, seg_len)
+        across = linear_interval(ex*fy - ey*fx, ex*u[1] - ey*u[0], -r, r)
+        b0, b1 = max(along[0], across[0]), min(along[1], across[1])
+        if b0 <= b1:
+            lo, hi = min(lo, b0), max(hi, b1)
+    lo, hi = max(lo, 0.0), min(hi, length)
+    return (lo, hi) if lo <= hi else None
+
+class MovingHits:
+    """移动目标的命中判定
+
+    光源只对镜子、障碍物和静止目标追踪, 得到缓存的路径 (LightSource.paths); 每一步只拿移动目标
+    和这些线段求交, 沿路径最先碰到的移动目标挡住光线, 光线画到那里为止. 路径不变就不重新追踪.
+
+    沿折线轨道运动的目标 (见 Target.track), 在路径变化时解析地算出它在轨道上的哪些路程区间
+    会碰到哪条线段; 之后每步只比较它当前的路程, 在两个区间端点之间移动时要检测的线段不变,
+    碰不到任何线段时什么都不用算. 轨道是曲线的目标 (8 字形) 每步检测包围盒重叠的线段.
+    """
+    def __init__(self, light):
+        self.light = light
+        self.movers = []
+        self.windows = {}  # 目标 -> (排好序的区间端点, [(起点路程, 终点路程, 光线下标, 段下标)])
+        self.spans = {}    # 目标 -> (lo, hi, 候选线段), 目标上一次所在的两相邻端点之间的区段
+        self.blocks = []   # 每条光线被挡住的位置 (段下标, 距段起点的距离, 目标) 或 None
+
+    def rebuild(self, movers):
+        """光路重新追踪之后调用: 重算接触区间并重新判定"""
+        self.movers = movers
+        self.windows = {}
+        self.spans = {}
+        paths = self.light.paths
+        for target in movers:
+            track = target.track()
+            if track is None:
+                continue
+            points, _ = track
+            r = target.radius + SHAPE_TOLERANCE
+            windows = []
+            start = 0.0
+            for a, b in zip(points, points[1:]):
+                length = math.dist(a, b)
+                if length > 0:
+                    u = ((b[0] - a[0]) / length, (b[1] - a[1]) / length)
+                    for i, record in enumerate(paths):
+                        for j, (p0, p1) in enumerate(record.segments):
+                            window = track_window(a, u, length, p0, p1, r)
+                            if window is not None:
+                                windows.append((start + window[0], start + window[1], i, j))
+                start += length
+            self.windows[target] = (sorted({w[k] for w in windows for k in (0, 1)}), windows)
+        old = self.blocks
+        self.blocks = [None] * len(paths)
+        self.update(force=[i for i, block in enumerate(old) if block is not None and i < len(paths)])
+
+    def candidates(self, target):
+        """目标当前位置可能碰到的 (光线下标, 段下标)"""
+        if target not in self.windows:
+            box = shape_box((target.x, target.y, target.radius))
+            return [(i, j) for i, record in enumerate(self.light.paths)
+                    for j, seg_box in enumerate(record.boxes) if boxes_overlap(seg_box, box)]
+        distance = target.track()[1]
+        span = self.spans.get(target)
+        if span is None or not span[0] <= distance <= span[1]:
+            bounds, windows = self.windows[target]
+            k = bisect.bisect_right(bounds, distance)
+            lo = bounds[k - 1] if k > 0 else -math.inf
+            hi = bounds[k] if k < len(bounds) else math.inf
+            span = (lo, hi, [(i, j) for d0, d1, i, j in windows if d0 <= distance <= d1])
+            self.spans[target] = span
+        return span[2]
+
+    def update(self, force=()):
+        """按移动目标当前的位置重新判定挡住的光线和命中状态, 返回光线是否变化
+
+        force 中的光线无论挡住位置是否变化都重新生成显示用的路径.
+        """
+        light = self.light
+        paths = light.paths
+        blocks = [None] * len(paths)
+        for target in self.movers:
+            for i, j in self.candidates(target):
+                p0, p1 = paths[i].segments[j]
+                length = math.dist(p0, p1)
+                if length == 0:
+                    continue
+                # 与追踪时一样用单位方向求交, 算出的挡住位置与整体追踪一致
+                direction = ((p1[0] - p0[0]) / length, (p1[1] - p0[1]) / length)
+                hit = light.target_intersection(p0, direction, target)
+                if hit is not None and hit['t'] <= length and (blocks[i] is None or (j, hit['t']) < blocks[i][:2]):
+                    blocks[i] = (j, hit['t'], target)
+        changed = set(force)
+        changed.update(i for i, (new, old) in enumerate(zip(blocks, self.blocks)) if new != old)
+        self.blocks = blocks
+        for i in changed:
+            path = paths[i].path
+            if blocks[i] is not None:
+                j, t, target = blocks[i]
+                (x0, y0), (x1, y1) = paths[i].segments[j]
+                length = math.dist((x0, y0), (x1, y1))
+                path = path[:j + 1] + [(x0 + (x1 - x0) / length * t, y0 + (y1 - y0) / length * t)]
+            light.rays[i] = clip_path(path)
+        hit = {block[2] for block in blocks if block is not None}
+        hit.update(target for target, block in zip(paths.targets, blocks) if block is None and target is not None)
+        light.hits = hit
+        for target in self.movers:
+            target.hit = target in hit
+        for target in paths.targets:
+            if target is not None:
+                target.hit = target in hit
+        if changed:
+            light.version += 1
+        return bool(changed)
+
+def mirror_arrays(mirrors):
+    """把镜子整理成数组: 起点、边向量、单位法线, 形状均为 (m, 2)"""
+    data = np.array([mirror_row(m) for m in mirrors], dtype=float).reshape(-1, 6)
+    return data[:, 0:2], data[:, 2:4], data[:, 4:6]
+
+def scene_arrays(index, mirrors, targets, obstacles):
+    """索引里的 SceneArrays 与这次追踪的物体一致时返回它, 否则返回 None 由追踪自己拼数组"""
+    if index is None or index.arrays is None or not index.arrays.matches(mirrors, targets, obstacles):
+        return None
+    return index.arrays
+
+def trace_rays_batch(starts, angles, mirrors, targets, max_bounces=MAX_BOUNCES, obstacles=()):
+    """NumPy 批量光线追踪
+
+    每次反弹把所有仍在传播的光线一次性与全部镜子、目标、障碍物求交, 判定规则与
+    LightSource.trace_ray 相同. 返回 (路径列表, 每条光线命中的目标下标), 未命中为 -1.
+    """
+    points, lengths, hits, missed = trace_batch_arrays(starts, angles, mirrors, targets, max_bounces, obstacles)
+    coords = points.transpose(1, 0, 2).tolist()
+    paths = [clip_path([tuple(p) for p in coords[i][:lengths[i]]]) for i in range(len(lengths))]
+    return paths, hits.tolist()
+
+def trace_batch_arrays(starts, angles, mirrors, targets, max_bounces=MAX_BOUNCES, obstacles=(), arrays=None):
+    """trace_rays_batch 的数组版本
+
+    返回 points (max_bounces+1, n, 2), 每条光线的有效点数 lengths (n,), 命中目标下标 hits (n,)
+    和是否射出场景 missed (n,).
+    starts 可以是每条光线各自的起点, 也可以是所有光线共用的一个起点.
+    arrays 为与 mirrors/targets/obstacles 一致的 SceneArrays 时直接使用其中的数组, 不再重新拼装.
+    """
+    n = len(angles)
+    pos = np.broadcast_to(np.asarray(starts, dtype=float), (n, 2)).copy()
+    angles = np.asarray(angles, dtype=float)
+    dirs = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    points = np.full((max_bounces + 1, n, 2), np.nan)
+    points[0] = pos
+    lengths = np.ones(n, dtype=int)
+    hits = np.full(n, -1, dtype=int)
+    missed_rays = np.zeros(n, dtype=bool)
+    alive = np.arange(n)
+
+    if arrays is not None:
+        p1, edge, normal = arrays.mirror_columns()
+        centers, radii = arrays.target_columns()
+        boxes = arrays.obstacles.view()
+    else:
+        if mirrors:
+            p1, edge, normal = mirror_arrays(mirrors)
+        if targets:
+            centers = np.array([(t.x, t.y) for t in targets], dtype=float)
+            radii = np.array([t.radius for t in targets], dtype=float)
+        if obstacles:
+            boxes = np.array([o.box() for o in obstacles], dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for bounce in range(max_bounces):
+            if alive.size == 0:
+                break
+            if PROFILER.enabled:
+                PROFILER.count('tests', alive.size * (len(mirrors) + len(targets) + len(obstacles)))
+            o = pos[alive]
+            d = dirs[alive]
+            dx = d[:, 0:1]
+            dy = d[:, 1:2]
+            rows = np.arange(alive.size)
+
+            # 目标: 射线与圆求交
+            target_t = np.full(alive.size, np.inf)
+            target_idx = np.full(alive.size, -1)
+            if targets:
+                fx = o[:, 0:1] - centers[:, 0]
+                fy = o[:, 1:2] - centers[:, 1]
+                a = dx*dx + dy*dy
+                b = 2*(dx*fx + dy*fy)
+                c = fx**2 + fy**2 - radii*radii
+                disc = b*b - 4*a*c
+                root = np.sqrt(np.where(disc < 0, 0, disc))
+                t1 = (-b + root) / (2*a)
+                t2 = (-b - root) / (2*a)
+                t_low = np.minimum(t1, t2)
+                t = np.where(t_low > 0, t_low, np.maximum(t1, t2))
+                t = np.where((disc >= 0) & (t >= 0), t, np.inf)
+                target_idx = np.argmin(t, axis=1)
+                target_t = t[rows, target_idx]
+
+            # 镜子: 射线与线段求交
+            mirror_t = np.full(alive.size, np.inf)
+            mirror_idx = np.zeros(alive.size, dtype=int)
+            if mirrors:
+                ex = edge[:, 0]
+                ey = edge[:, 1]
+                wx = p1[:, 0] - o[:, 0:1]
+                wy = p1[:, 1] - o[:, 1:2]
+                denom = ey*dx - ex*dy
+                t = (wx*ey - wy*ex) / denom
+                u = (wx*dy - wy*dx) / denom
+                valid = (np.abs(denom) >= 1e-6) & (t >= RAY_EPSILON) & (u >= 0) & (u <= 1)
+                t = np.where(valid, t, np.inf)
+                mirror_idx = np.argmin(t, axis=1)
+                mirror_t = t[rows, mirror_idx]
+
+            # 障碍物: slab 求交, 起点在障碍物内时 t 为 0; 0/0 (起点正好在边上) 按在 slab 内处理
+            block_t = np.full(alive.size, np.inf)
+            if obstacles:
+                tx1 = (boxes[:, 0] - o[:, 0:1]) / dx
+                tx2 = (boxes[:, 2] - o[:, 0:1]) / dx
+                ty1 = (boxes[:, 1] - o[:, 1:2]) / dy
+                ty2 = (boxes[:, 3] - o[:, 1:2]) / dy
+                t_enter = np.fmax(np.fmin(tx1, tx2), np.fmin(ty1, ty2))
+                t_leave = np.fmin(np.fmax(tx1, tx2), np.fmax(ty1, ty2))
+                t_enter = np.nan_to_num(t_enter, nan=-np.inf)
+                t_leave = np.nan_to_num(t_leave, nan=np.inf)
+                t = np.maximum(t_enter, 0)
+                t = np.where(t_leave >= t, t, np.inf)
+                block_t = t.min(axis=1)
+
+            # 与 trace_ray 相同: 距离相等时目标优先, 其次镜子, 障碍物要更近才挡住
+            blocked = block_t < np.minimum(mirror_t, target_t)
+            reflected = (mirror_t < target_t) & ~blocked
+            hit_target = ~reflected & ~blocked & np.isfinite(target_t)
+            missed = ~reflected & ~hit_target & ~blocked
+            t = np.where(reflected, mirror_t, target_t)
+            t = np.where(blocked, block_t, t)
+            t = np.where(missed, RAY_MISS_LENGTH, t)
+            new_pos = o + d*t[:, None]
+
+            points[bounce + 1, alive] = new_pos
+            lengths[alive] += 1
+            hits[alive[hit_target]] = target_idx[hit_target]
+            missed_rays[alive[missed]] = True
+
+            d_in = d[reflected]
+            n_hat = normal[mirror_idx[reflected]] if mirrors else d_in
+            dot = (d_in*n_hat).sum(axis=1, keepdims=True)
+            alive = alive[reflected]
+            pos[alive] = new_pos[reflected]
+            dirs[alive] = d_in - 2*dot*n_hat
+
+    return points, lengths, hits, missed_rays
+
+class DenseBeam:
+    """密集光束模式
+
+    一个光源同时发出成百上千条光线: 用 trace_batch_arrays 追踪, 只在光线变化时把整束光
+    画到一张缓存表面上, 之后每帧只 blit 一次. 每次重新追踪都计时, 超出帧预算就减少光线数,
+    预算宽裕时再逐步加回用户设定的数量.
+    """
+    def __init__(self, light, num_rays=DENSE_DEFAULT_RAYS, budget_ms=DENSE_FRAME_BUDGET_MS):
+        self.light = light
+        self.num_rays = num_rays
+        self.active_rays = num_rays
+        self.budget_ms = budget_ms
+        self.cost_ms = 0.0
+        self.trace_ms = 0.0
+        self.recent_costs = deque(maxlen=3)
+        self.coords = None
+        self.lengths = None
+        self.surface = None
+        self.rect = None  # 光束实际画到的区域
+
+    def set_num_rays(self, num_rays):
+        self.num_rays = max(DENSE_MIN_RAYS, min(DENSE_MAX_RAYS, int(num_rays)))
+        self.active_rays = self.num_rays
+        self.recent_costs.clear()
+        self.light.changed()
+
+    def trace(self, devices, targets, index=None):
+        start = time.perf_counter()
+        light = self.light
+        half = math.radians(light.spread/2)
+        angles = np.linspace(half, -half, self.active_rays)
+        mirrors = [d for d in devices if isinstance(d, Mirror)]
+        obstacles = [d for d in devices if isinstance(d, Obstacle)]
+        points, lengths, hits, missed = trace_batch_arrays((light.x, light.y), angles, mirrors, targets,
+                                                           obstacles=obstacles,
+                                                           arrays=scene_arrays(index, mirrors, targets, obstacles))
+        lit = {targets[index] for index in np.unique(hits[hits >= 0])}
+        for target in lit:
+            target.hit = True
+        self.coords = points.transpose(1, 0, 2).tolist()
+        self.lengths = lengths.tolist()
+        self.surface = None
+        self.rect = None
+        self.trace_ms = (time.perf_counter() - start) * 1000
+        return lit
+
+    def render(self):
+        """把整束光画到缓存表面; 耗时与追踪耗时合计后用于调整光线数"""
+        start = time.perf_counter()
+        # 黑色作透明色, 整张表面半透明叠加; 线宽 1 时 C 实现的 draw.lines 比逐像素采样更快
+        beam = pygame.Surface((WIDTH, HEIGHT))
+        beam.set_colorkey(BLACK)
+        beam.set_alpha(DENSE_BEAM_ALPHA)
+        rects = [pygame.draw.lines(beam, YELLOW, False, ray[:length], 1)
+                 for ray, length in zip(self.coords, self.lengths) if length >= 2]
+        self.surface = beam
+        self.rect = rects[0].unionall(rects[1:]) if rects else pygame.Rect(0, 0, 0, 0)
+
+        self.cost_ms = self.trace_ms + (time.perf_counter() - start) * 1000
+        self.recent_costs.append(self.cost_ms)
+        self.adapt()
+
+    def adapt(self):
+        """按最近几次追踪耗时的中位数调整光线数, 偶发的卡顿不会让光线数来回跳"""
+        cost = sorted(self.recent_costs)[(len(self.recent_costs) - 1) // 2]
+        if cost > self.budget_ms and self.active_rays > DENSE_MIN_RAYS:
+            ratio = self.budget_ms / cost * 0.9
+            self.active_rays = max(DENSE_MIN_RAYS, int(self.active_rays * ratio))
+            self.recent_costs.clear()
+            self.light.changed()
+        elif cost < self.budget_ms * 0.5 and self.active_rays < self.num_rays:
+            self.active_rays = min(self.num_rays, int(self.active_rays * 1.25) + 1)
+            self.light.changed()
+
+    def draw(self, surface):
+        if self.surface is None and self.coords is not None:
+            self.render()
+        if self.surface is not None:
+            surface.blit(self.surface, (0, 0))
+
+class HeatMap:
+    """光照热力图 (需要 NumPy)
+
+    从光源向扇形内发射大量光线, 用 trace_batch_arrays 按与 trace_ray 相同的规则反射, 把每条光线
+    经过的路程累加到 HEATMAP_CELL 大小的网格里. 每帧只追踪 HEATMAP_BATCH 条, 图像逐帧细化而
+    不卡住画面, 每批光线数按上一批的耗时调整到 HEATMAP_BUDGET_MS 左右; 方向按黄金分割序列取, 任何时刻已发出的光线都大致均匀地铺满扇形.
+    镜子、光源或关卡变化时清零重来. 移动目标不参与, 否则它每走一步累积都要作废.
+    有多个光源时每批对每个光源各发一次, 光照叠加在同一张图上.
+    """
+    def __init__(self, cell=HEATMAP_CELL, batch=HEATMAP_BATCH, max_rays=HEATMAP_MAX_RAYS, budget_ms=HEATMAP_BUDGET_MS):
+        self.cell = cell
+        self.batch = batch
+        self.budget_ms = budget_ms
+        self.max_rays = max_rays
+        self.grid = np.zeros((math.ceil(WIDTH / cell), math.ceil(HEIGHT / cell)))
+        self.key = None
+        self.rays = 0
+        self.version = 0  # 每次累积后加一
+        self.surface = None
+        self.surface_version = -1
+        self.surface_time = None
+
+    @staticmethod
+    def geometry_key(sim):
+        """决定光照分布的全部几何; 与上次不同就要清零"""
+        return (sim.level, tuple((light.x, light.y, light.spread) for light in sim.lights),
+                tuple(m.get_end_points() for m in sim.devices))
+
+    def accumulate(self, sim):
+        """再追踪一批光线并累加, 返回是否有新数据"""
+        key = self.geometry_key(sim)
+        if key != self.key:
+            self.key = key
+            self.grid[:] = 0
+            self.rays = 0
+            self.version += 1
+        if self.rays >= self.max_rays:
+            return False
+        started = time.perf_counter()
+        golden = (math.sqrt(5) - 1) / 2
+        fractions = (np.arange(self.rays, self.rays + self.batch) * golden) % 1.0
+        mirrors = [d for d in sim.devices if isinstance(d, Mirror)]
+        obstacles = sim.level.obstacles
+        arrays = scene_arrays(sim.index, mirrors, sim.static_targets, obstacles)
+        for light in sim.lights:
+            half = math.radians(light.spread / 2)
+            self.deposit_rays(trace_batch_arrays((light.x, light.y), half - 2 * half * fractions, mirrors,
+                                                 sim.static_targets, MAX_BOUNCES, obstacles, arrays))
+        self.rays += self.batch
+        self.version += 1
+        PROFILER.count('rays', self.batch * len(sim.lights))
+        cost = (time.perf_counter() - started) * 1000
+        self.batch = max(10, min(4 * self.batch, int(self.batch * self.budget_ms / max(cost, 0.01))))
+        return True
+
+    def deposit_rays(self, traced):
+        """累加一批 trace_batch_arrays 的结果"""
+        points, lengths, hits, missed = traced
+        # 射出场景的光线把最后一段延长到屏幕边缘为止, 屏幕外的部分采样也是白费
+        rows = np.flatnonzero(missed)
+        last = lengths[rows] - 1
+        start = points[last - 1, rows]
+        tail = points[last, rows] - start
+        tail /= np.hypot(tail[:, 0], tail[:, 1])[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reach = np.fmin(np.where(tail[:, 0] > 0, WIDTH - start[:, 0], -start[:, 0]) / tail[:, 0],
+                            np.where(tail[:, 1] > 0, HEIGHT - start[:, 1], -start[:, 1]) / tail[:, 1])
+        reach = np.clip(np.nan_to_num(reach, nan=0.0, posinf=RAY_BOX_REACH), 0, RAY_BOX_REACH)
+        points[last, rows] = start + tail * reach[:, None]
+        for k in range(points.shape[0] - 1):
+            valid = lengths > k + 1
+            if valid.any():
+                self.deposit(points[k, valid], points[k + 1, valid])
+
+    def deposit(self, p0, p1):
+        """沿每条线段每隔不到一格取一个采样点, 把该段长度平均分给这些点所在的格子"""
+        d = p1 - p0
+        length = np.hypot(d[:, 0], d[:, 1])
+        count = np.maximum(np.ceil(length / self.cell).astype(int), 1)
+        seg = np.repeat(np.arange(len(count)), count)
+        offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        t = (offset + 0.5) / count[seg]
+        xy = p0[seg] + d[seg] * t[:, None]
+        cx = np.floor(xy[:, 0] / self.cell).astype(int)
+        cy = np.floor(xy[:, 1] / self.cell).astype(int)
+        w, h = self.grid.shape
+        inside = (cx >= 0) & (cx < w) & (cy >= 0) & (cy < h)
+        flat = cx[inside] * h + cy[inside]
+        self.grid += np.bincount(flat, weights=(length / count)[seg][inside], minlength=w * h).reshape(w, h)
+
+    def render(self, now):
+        """返回画好的热力图表面; 有新数据时最多每 HEATMAP_REDRAW_MS 毫秒重画一次, 累积结束时立即重画"""
+        if self.surface_version != self.version and (
+                self.surface is None or now - self.surface_time >= HEATMAP_REDRAW_MS or self.rays >= self.max_rays):
+            self.surface_version = self.version
+            self.surface_time = now
+            self.surface = None
+            peak = self.grid.max()
+            if peak > 0:
+                # 对数刻度: 镜子聚光处比普通区域亮几个数量级, 线性刻度下其余部分几乎全黑
+                v = np.log1p(self.grid) / math.log1p(peak)
+                rgb = np.stack([np.clip(3*v, 0, 1), np.clip(3*v - 1, 0, 1), np.clip(3*v - 2, 0, 1)], axis=-1)
+                # 没有光的格子完全透明; 用逐像素透明度而不是透明色, 平滑缩放后边缘不会出现黑边
+                small = pygame.Surface(self.grid.shape, pygame.SRCALPHA)
+                pygame.surfarray.blit_array(small, (rgb * 255).astype(np.uint8))
+                pygame.surfarray.pixels_alpha(small)[:] = np.where(self.grid > 0, HEATMAP_ALPHA, 0).astype(np.uint8)
+                self.surface = pygame.transform.smoothscale(
+                    small, (self.grid.shape[0] * self.cell, self.grid.shape[1] * self.cell))
+        return self.surface
+
+    def draw(self, surface, now):
+        heat = self.render(now)
+        if heat is not None:
+            field = pygame.Rect(TOOLBAR_WIDTH, 0, WIDTH - TOOLBAR_WIDTH, HEIGHT)
+            surface.blit(heat, field, field)
+
 class GameLevel:
-    """游戏关卡"""
-    def __init__(self, level_num):
+    """游戏关卡
+
+    data 为 None 时使用内置的关卡 level_num, 否则按关卡文件中的一条记录 (见 to_dict) 构造.
+    关卡可以有多个光源 (lights), 每个可以指定自己的 num_rays 和 spread; 第一个由玩家用方向键调节.
+    """
+    def __init__(self, level_num, data=None):
         self.level_num    = level_num 
         self.targets    = []
         self.obstacles   = []
         self.mirror_limit    = 99 
         self.time_limit    = 0 
+        self.lights    = [{'x': 200, 'y': 400}]  # 光源位置, 可带 num_rays/spread 
         self.completed    = False 
         self.score    = 0 
-        self.setup_level()    
+        if data is None:
+            self.setup_level()    
+        else:
+            self.load_data(data)
+
+    @property
+    def light(self):
+        """第一个光源的位置"""
+        return (self.lights[0]['x'], self.lights[0]['y'])
+
+    def load_data(self, data):
+        self.mirror_limit = data.get('mirror_limit', self.mirror_limit)
+        self.time_limit = data.get('time_limit', self.time_limit)
+        if 'lights' in data:
+            self.lights = [light_from_dict(light) for light in data['lights']]
+            if not self.lights:
+                raise ValueError("lights 不能为空")
+        else:
+            x, y = data.get('light', self.light)
+            self.lights = [{'x': x, 'y': y}]
+        self.targets.extend(target_from_dict(target) for target in data.get('targets', []))
+        self.obstacles.extend(Obstacle(*rect) for rect in data.get('obstacles', []))
+
+    def to_dict(self):
+        return {
+            'mirror_limit': self.mirror_limit,
+            'time_limit': self.time_limit,
+            'light': list(self.light),
+            **({'lights': [dict(light) for light in self.lights]} if self.lights != [{'x': self.light[0], 'y': self.light[1]}] else {}),
+            'targets': [target.to_dict() for target in self.targets],
+            'obstacles': [list(obstacle.rect) for obstacle in self.obstacles],
+        }
         
     def setup_level(self):
         if self.level_num    == 1:
@@ -341,6 +2007,12 @@ class GameLevel:
             self.mirror_limit    = 6 
             self.time_limit    = 120  
             
+    def apply_hits(self, hit_sets):
+        """把各光源照到的目标合并到 target.hit, 任一光源照到就算命中"""
+        lit = set().union(*hit_sets)
+        for target in self.targets:
+            target.hit = target in lit
+
     def check_completion(self):
         self.completed   = all(t.hit   for t in self.targets)   
         return self.completed    
@@ -351,49 +2023,1657 @@ class GameLevel:
         time_bonus = int(time_remaining) * 2 if self.time_limit   > 0 else 0 
         self.score   = base_score + mirror_bonus + time_bonus 
         return self.score    
+
+def light_from_dict(data):
+    """关卡文件中的一个光源: 必须有 x, y, 可选 num_rays (1 以上) 和 spread"""
+    light = {'x': data['x'], 'y': data['y']}
+    if 'num_rays' in data:
+        if int(data['num_rays']) < 1:
+            raise ValueError(f"num_rays 必须至少为 1, 而不是 {data['num_rays']}")
+        light['num_rays'] = int(data['num_rays'])
+    if 'spread' in data:
+        light['spread'] = float(data['spread'])
+    return light
+
+class BuiltinLevels:
+    """代码中内置的关卡, 与 LevelPack 接口相同"""
+    def __len__(self):
+        return LEVEL_COUNT
+
+    def level(self, level_num):
+        if not 1 <= level_num <= LEVEL_COUNT:
+            raise ValueError(f"没有第 {level_num} 关 (内置关卡共 {LEVEL_COUNT} 关)")
+        return GameLevel(level_num)
+
+BUILTIN_LEVELS = BuiltinLevels()
+
+class LevelPack:
+    """JSON Lines 格式的关卡包, 每行一个关卡 (GameLevel.to_dict 的格式), 第一行是第 1 关
+
+    打开时只扫描一遍记下每行的文件偏移, 不解析内容; 加载某一关时才读出那一行解析,
+    最近用过的 LEVEL_CACHE_SIZE 关的解析结果留在内存里. 几百关的关卡包也不会拖慢启动.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = []
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    self.offsets.append(offset)
+                offset += len(line)
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def data(self, level_num):
+        if level_num in self.cache:
+            # 命中的关卡移到最后, 淘汰时总是去掉最久没用过的
+            self.cache[level_num] = self.cache.pop(level_num)
+            return self.cache[level_num]
+        if not 1 <= level_num <= len(self.offsets):
+            raise ValueError(f"{self.path} 没有第 {level_num} 关 (共 {len(self.offsets)} 关)")
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[level_num - 1])
+            line = f.readline()
+        try:
+            data = json.loads(line)
+        except ValueError as exc:
+            raise ValueError(f"{self.path} 第 {level_num} 关格式错误: {exc}") from None
+        if not isinstance(data, dict):
+            raise ValueError(f"{self.path} 第 {level_num} 关格式错误: 应为 JSON 对象, 而不是 {type(data).__name__}")
+        if len(self.cache) >= LEVEL_CACHE_SIZE:
+            del self.cache[next(iter(self.cache))]
+        self.cache[level_num] = data
+        return data
+
+    def level(self, level_num):
+        data = self.data(level_num)
+        try:
+            return GameLevel(level_num, data)
+        except KeyError as exc:
+            raise ValueError(f"{self.path} 第 {level_num} 关缺少字段 {exc}") from None
+        except (TypeError, ValueError, AttributeError) as exc:
+            raise ValueError(f"{self.path} 第 {level_num} 关有误: {exc}") from None
+
+def open_levels(path=None):
+    """关卡包路径为空时使用内置关卡"""
+    return LevelPack(path) if path else BUILTIN_LEVELS
  
-def main():
+class Simulation:
+    """无界面的游戏模拟核心
+
+    持有当前关卡、镜子和光源, 用 step(dt) 推进时间、trace() 计算光路, 所有玩家操作都有对应方法.
+    不导入 pygame, 时间来自注入的 clock (默认 SimClock), 因此可以在服务器、测试和基准中
+    以任意速度运行. main() 只负责把输入事件翻译成这些调用并画出结果.
+
+    场景的一切变化都汇总到 mark_dirty: 物体变化只记下它的新旧形状, trace() 时只重算缓存路径
+    经过这些位置的光线; 关卡、光源参数等整体变化则全部重算. 没有变化时 trace() 不做任何事.
+    """
+    def __init__(self, level_num=1, clock=None, levels=None, workers=None):
+        self.clock = clock or SimClock()
+        self.levels = levels or BUILTIN_LEVELS  # 关卡来源: 内置关卡或 LevelPack
+        self.light = LightSource(200, 400)  # 第一个光源, 玩家的调节都作用在它上面
+        self.light.scene = self
+        self.lights = [self.light]
+        self.workers = workers or os.cpu_count() or 1  # 多个光源时并行追踪的线程数
+        self.pool = None
+        self.devices = []
+        self.total_score = 0
+        self.trace_count = 0  # 累计追踪次数
+        self.steps = 0  # 累计模拟步数, 回放按它对齐操作的时间
+        self.frame_stats = {'traces': 0, 'rays': 0}  # 本帧 (自上次 advance 以来) 的追踪次数和光线数
+        self.accumulator = 0.0  # 还没模拟的真实时间
+        self.load_level(level_num)
+
+    def mark_dirty(self, item=None):
+        """场景变化的唯一入口; item 为 None 表示整体变化, 否则是移动或旋转过的镜子、目标"""
+        if item is None:
+            self.dirty = True
+            self.changes = []
+            return
+        if item not in self.index:
+            return
+        old_shape = self.index.shape(item)
+        self.index.update(item)
+        if not self.dirty:
+            self.changes.append((item, old_shape, self.index.shape(item)))
+
+    def load_level(self, level_num):
+        self.current_level = level_num
+        self.use_level(self.levels.level(level_num))
+
+    def use_level(self, level):
+        """换上一个构造好的关卡, 例如基准测试随机生成的场景"""
+        for mirror in self.devices:
+            mirror.scene = None
+        self.level = level
+        self.light.x, self.light.y = level.light
+        self.lights = [self.light]
+        for spec in level.lights[1:]:
+            light = LightSource(spec['x'], spec['y'])
+            light.scene = self
+            self.lights.append(light)
+        for light, spec in zip(self.lights, level.lights):
+            light.num_rays = spec.get('num_rays', light.num_rays)
+            light.spread = spec.get('spread', light.spread)
+        self.devices = []
+        self.index = SceneIndex()
+        # 移动目标不进索引也不参与追踪, 由 light.moving 对缓存的路径判定
+        self.movers = [t for t in self.level.targets if isinstance(t, MOVING_TARGETS)]
+        self.static_targets = [t for t in self.level.targets if not isinstance(t, MOVING_TARGETS)]
+        self.movers_moved = False
+        for target in self.static_targets:
+            self.index.add(target)
+        for obstacle in self.level.obstacles:
+            self.index.add(obstacle)
+        self.start_time = self.clock.time
+        self.time_left = self.level.time_limit
+        self.mark_dirty()
+
+    def next_level(self):
+        self.load_level(self.current_level % len(self.levels) + 1)
+
+    def restart(self):
+        """清空镜子并重新计时"""
+        self.clear_mirrors()
+        self.start_time = self.clock.time
+
+    def clear_mirrors(self):
+        for mirror in self.devices:
+            self.index.remove(mirror)
+            mirror.scene = None
+        self.devices = []
+        self.mark_dirty()
+
+    def add_mirror(self, x, y, angle=0):
+        """放置一面镜子; 达到本关上限时返回 None"""
+        if len(self.devices) >= self.level.mirror_limit:
+            return None
+        mirror = Mirror(x, y, clock=self.clock)
+        mirror.angle = angle
+        self.index.add(mirror)  # 坐标不合法时在这里出错, 镜子还没进入场景
+        mirror.scene = self
+        self.devices.append(mirror)
+        if not self.dirty:
+            self.changes.append((mirror, None, self.index.shape(mirror)))
+        return mirror
+
+    def copy_mirror(self, mirror):
+        return self.add_mirror(mirror.x + 20, mirror.y + 20, mirror.angle)
+
+    def remove_mirror(self, mirror):
+        if mirror not in self.devices:
+            return
+        if not self.dirty:
+            self.changes.append((mirror, self.index.shape(mirror), None))
+        self.devices.remove(mirror)
+        self.index.remove(mirror)
+        mirror.scene = None
+
+    def move_mirror(self, mirror, x, y):
+        mirror.move(x, y)
+
+    def rotate_mirror(self, mirror, delta):
+        mirror.angle += delta
+        mirror.needs_update = True
+
+    def set_num_rays(self, num_rays):
+        self.light.num_rays = num_rays
+        self.light.changed()
+
+    def set_spread(self, spread):
+        self.light.spread = spread
+        self.light.changed()
+
+    def set_dense(self, enabled):
+        return self.light.set_dense(enabled)
+
+    def set_beam_rays(self, num_rays):
+        if self.light.dense is not None:
+            self.light.dense.set_num_rays(num_rays)
+
+    def pick(self, x, y):
+        return pick_device(self.devices, x, y, self.index)
+
+    def step(self, dt):
+        """推进 dt 秒: 计时、超时退回上一关、移动目标"""
+        self.steps += 1
+        self.clock.advance(dt)
+        if self.level.time_limit > 0:
+            elapsed = self.clock.time - self.start_time
+            self.time_left = max(0, self.level.time_limit - elapsed)
+            if self.time_left <= 0 and not self.level.completed:
+                self.load_level(max(1, self.current_level - 1))
+
+        for target in self.movers:
+            target.update(dt)
+            if target.moved:
+                self.movers_moved = True
+
+    def advance(self, frame_dt):
+        """把一帧的真实时间按固定步长 SIM_STEP 模拟掉, 返回渲染插值系数 (0~1)
+
+        不足一步的时间留到下一帧, 渲染时目标画在上一步和当前步之间, 帧率高低都一样平滑.
+        每帧调用一次, 同时开始统计新一帧的 frame_stats; 这一帧可能一步都不模拟.
+        """
+        self.frame_stats = {'traces': 0, 'rays': 0}
+        self.accumulator += min(frame_dt, MAX_FRAME_TIME)
+        while self.accumulator >= SIM_STEP:
+            self.step(SIM_STEP)
+            self.accumulator -= SIM_STEP
+        return self.accumulator / SIM_STEP
+
+    def trace_light(self, light, devices, full, changes):
+        """更新一个光源的光线, 返回重新追踪的光线数
+
+        只有移动目标动了时不重新追踪, 只让 light.moving 重新判定; 密集光束模式整体追踪, 移动目标直接参与.
+        """
+        if light.dense is not None:
+            light.update_rays(devices, self.level.targets, self.index)
+            return light.last_traced
+        if full or changes:
+            light.update_rays(devices, self.static_targets, self.index, None if full else changes)
+            light.moving.rebuild(self.movers)
+            return light.last_traced
+        started = PROFILER.start()
+        light.moving.update()
+        PROFILER.stop('update_rays', started)
+        return 0
+
+    def trace_lights_parallel(self, devices):
+        """多个光源一起重算, 批量追踪连同路径缓存的构建放进线程池, 返回重新追踪的光线数
+
+        PathTable.trace 用 NumPy 追踪并直接从结果数组算出各段的线段和包围盒, 这些运算执行时不占 GIL,
+        各光源可以真正并行; 剩下按光线生成显示路径的 Python 循环很短. 缓存是 PathList (光线少于
+        TABLE_MIN_RAYS) 或这次要重算的光线少于 BATCH_MIN_RAYS 的光源, 追踪和维护缓存一直持有 GIL,
+        所以留在当前线程里做, 与线程池中其他光源的批量追踪同时进行. 密集光束模式的光源照旧由 trace_light 处理.
+        """
+        started = PROFILER.start()
+        mirrors = [d for d in devices if isinstance(d, Mirror)]
+        obstacles = self.level.obstacles
+        targets = self.static_targets
+        arrays = scene_arrays(self.index, mirrors, targets, obstacles)
+        changes = None if self.dirty else self.changes
+        traced = 0
+        jobs = []
+        for light in self.lights:
+            if light.dense is not None:
+                traced += self.trace_light(light, devices, self.dirty, self.changes)
+                continue
+            angles, todo = light.plan_rays(changes)
+            future = None
+            if light.batch_todo(todo):
+                future = self.pool.submit(light.paths.trace, todo, (light.x, light.y), [angles[i] for i in todo],
+                                          mirrors, targets, obstacles, arrays)
+            jobs.append((light, angles, todo, future))
+        for light, angles, todo, future in jobs:
+            if future is None:
+                rays = light.trace_todo(angles, todo, devices, targets, self.index)
+            else:
+                rays = future.result()
+            light.store_rays(angles, todo, rays, targets)
+            light.moving.rebuild(self.movers)
+            traced += light.last_traced
+        PROFILER.stop('update_rays', started)
+        return traced
+
+    def trace(self):
+        """场景有变化时重新计算受影响的光线, 返回第一个光源的光线列表
+
+        多个光源要重算时由 trace_lights_parallel 在线程池里并行批量追踪; 最后合并各光源的命中结果.
+        """
+        moved = self.movers_moved
+        self.movers_moved = False
+        if not (self.dirty or self.changes or moved):
+            return self.light.rays
+        devices = self.devices + self.level.obstacles
+        if len(self.lights) > 1 and self.workers > 1 and np is not None and (self.dirty or self.changes):
+            if self.pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            traced = self.trace_lights_parallel(devices)
+        else:
+            traced = sum(self.trace_light(light, devices, self.dirty, self.changes) for light in self.lights)
+        self.level.apply_hits([light.hits for light in self.lights])
+        self.dirty = False
+        self.changes = []
+        for mirror in self.devices:
+            mirror.needs_update = False
+        self.trace_count += 1
+        self.frame_stats['traces'] += 1
+        self.frame_stats['rays'] += traced
+        return self.light.rays
+
+    def release(self):
+        """松开鼠标时判定过关: 全部目标被照亮则计分并进入下一关, 返回是否过关"""
+        if not self.level.check_completion():
+            return False
+        self.total_score += self.level.calculate_score(len(self.devices), self.time_left)
+        self.next_level()
+        return True
+
+def write_varint(out, n):
+    """非负整数写成 LEB128 变长整数, 小于 128 只占一个字节"""
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def write_number(out, value, base=0):
+    """数值写成与 base 的差; 都是整数时用 zigzag 变长整数, 否则原样写 8 字节浮点, 回放时分毫不差"""
+    if float(value).is_integer() and float(base).is_integer():
+        delta = int(value) - int(base)
+        write_varint(out, (delta * 2 if delta >= 0 else -delta * 2 - 1) << 1)
+    else:
+        write_varint(out, 1)
+        out.extend(struct.pack('<d', value))
+
+def read_number(data, pos, base=0):
+    tag, pos = read_varint(data, pos)
+    if tag & 1:
+        return struct.unpack_from('<d', data, pos)[0], pos + 8
+    z = tag >> 1
+    return int(base) + (z >> 1 if z % 2 == 0 else -((z + 1) >> 1)), pos
+
+class Recorder:
+    """录像: 包装一个 Simulation, 玩家操作照常转给它, 同时写进紧凑的二进制文件
+
+    没有单独定义的属性和方法都直接转给被包装的 sim, main() 可以原样使用.
+    文件头之后每条记录是 操作码 + 距上一条记录的模拟步数 + 参数; 镜子用它在 devices 中的
+    下标表示, 拖动只记坐标增量. 计时和目标运动只取决于模拟步数, 不用记录. 命中判定取决于
+    操作前最后一次追踪的时刻, 它在下一次操作之前写成一条 trace 记录, 其间的追踪都不记;
+    密集光束的光线数随真实耗时调整, 也记在 trace 记录里.
+    """
+    def __init__(self, sim, path, levels_path=None):
+        self.sim = sim
+        self.file = open(path, 'wb')
+        self.last_step = sim.steps
+        self.pending = None  # 还没写出的最近一次追踪: (步数, 密集光束光线数)
+        header = bytearray(REPLAY_MAGIC)
+        header.append(REPLAY_VERSION)
+        header.extend(struct.pack('<d', SIM_STEP))
+        write_varint(header, sim.current_level)
+        name = (levels_path or '').encode('utf-8')
+        write_varint(header, len(name))
+        header.extend(name)
+        self.file.write(header)
+
+    def __getattr__(self, name):
+        return getattr(self.sim, name)
+
+    def emit(self, out, op, step, fields):
+        out.append(REPLAY_OPS.index(op))
+        write_varint(out, step - self.last_step)
+        self.last_step = step
+        for value, base in fields:
+            write_number(out, value, base)
+
+    def write(self, op, *fields):
+        """写一条记录; fields 为 (数值, 基准) 对"""
+        out = bytearray()
+        if self.pending is not None:
+            step, beam = self.pending
+            self.pending = None
+            self.emit(out, 'trace', step, [(beam, 0)])
+        self.emit(out, op, self.sim.steps, fields)
+        self.file.write(out)
+
+    def mirror_index(self, mirror):
+        """镜子在 devices 中的下标; 换关后残留的旧镜子返回 None, 对它的操作不影响场景, 不用记录"""
+        return self.sim.devices.index(mirror) if mirror in self.sim.devices else None
+
+    def trace(self):
+        count = self.sim.trace_count
+        rays = self.sim.trace()
+        if self.sim.trace_count != count:
+            dense = self.sim.light.dense
+            self.pending = (self.sim.steps, dense.active_rays if dense is not None else 0)
+        return rays
+
+    def add_mirror(self, x, y, angle=0):
+        mirror = self.sim.add_mirror(x, y, angle)
+        if mirror is not None:
+            self.write('add', (x, 0), (y, 0), (angle, 0))
+        return mirror
+
+    def copy_mirror(self, mirror):
+        return self.add_mirror(mirror.x + 20, mirror.y + 20, mirror.angle)
+
+    def remove_mirror(self, mirror):
+        i = self.mirror_index(mirror)
+        self.sim.remove_mirror(mirror)
+        if i is not None:
+            self.write('remove', (i, 0))
+
+    def move_mirror(self, mirror, x, y):
+        i = self.mirror_index(mirror)
+        old_x, old_y = mirror.x, mirror.y
+        self.sim.move_mirror(mirror, x, y)
+        if i is not None and (x, y) != (old_x, old_y):
+            self.write('move', (i, 0), (x, old_x), (y, old_y))
+
+    def rotate_mirror(self, mirror, delta):
+        i = self.mirror_index(mirror)
+        self.sim.rotate_mirror(mirror, delta)
+        if i is not None:
+            self.write('rotate', (i, 0), (delta, 0))
+
+    def set_num_rays(self, num_rays):
+        self.sim.set_num_rays(num_rays)
+        self.write('rays', (num_rays, 0))
+
+    def set_spread(self, spread):
+        self.sim.set_spread(spread)
+        self.write('spread', (spread, 0))
+
+    def set_dense(self, enabled):
+        result = self.sim.set_dense(enabled)
+        self.write('dense', (int(self.sim.light.dense is not None), 0))
+        return result
+
+    def set_beam_rays(self, num_rays):
+        self.sim.set_beam_rays(num_rays)
+        self.write('beam_rays', (num_rays, 0))
+
+    def clear_mirrors(self):
+        self.sim.clear_mirrors()
+        self.write('clear')
+
+    def restart(self):
+        self.sim.restart()
+        self.write('restart')
+
+    def next_level(self):
+        self.sim.next_level()
+        self.write('next')
+
+    def release(self):
+        result = self.sim.release()
+        self.write('release')
+        return result
+
+    def close(self):
+        self.write('end')
+        self.file.close()
+
+def replay_file(path):
+    """无界面地按录像重新模拟, 不等真实时间; 返回总分、最后所在关卡和每次过关的记录
+
+    录像中途中断 (游戏崩溃) 时照样回放到最后一条记录, 结果里 complete 为 False.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = len(REPLAY_MAGIC) + 9
+    if data[:len(REPLAY_MAGIC)] != REPLAY_MAGIC or len(data) < pos:
+        raise ValueError(f"{path} 不是录像文件")
+    if data[len(REPLAY_MAGIC)] != REPLAY_VERSION:
+        raise ValueError(f"{path} 的录像版本 {data[len(REPLAY_MAGIC)]} 不受支持")
+    if struct.unpack_from('<d', data, len(REPLAY_MAGIC) + 1)[0] != SIM_STEP:
+        raise ValueError(f"{path} 录制时的模拟步长与当前版本不同, 无法准确回放")
+    try:
+        level_num, pos = read_varint(data, pos)
+        length, pos = read_varint(data, pos)
+        levels_path = data[pos:pos + length].decode('utf-8') or None
+        pos += length
+    except IndexError:
+        raise ValueError(f"{path} 文件头不完整") from None
+
+    sim = Simulation(level_num, levels=open_levels(levels_path))
+    completions = []
+    started = time.perf_counter()
+    op = None
+    try:
+        while pos < len(data):
+            if data[pos] >= len(REPLAY_OPS):
+                raise ValueError(f"{path} 偏移 {pos} 处有未知的操作码 {data[pos]}")
+            op = REPLAY_OPS[data[pos]]
+            steps, pos = read_varint(data, pos + 1)
+            for _ in range(steps):
+                sim.step(SIM_STEP)
+            if op == 'end':
+                break
+            elif op == 'trace':
+                beam, pos = read_number(data, pos)
+                dense = sim.light.dense
+                if dense is not None and dense.active_rays != beam:
+                    dense.active_rays = beam
+                    sim.light.changed()
+                sim.trace()
+            elif op == 'add':
+                x, pos = read_number(data, pos)
+                y, pos = read_number(data, pos)
+                angle, pos = read_number(data, pos)
+                sim.add_mirror(x, y, angle)
+            elif op in ('remove', 'move', 'rotate'):
+                i, pos = read_number(data, pos)
+                mirror = sim.devices[i]
+                if op == 'remove':
+                    sim.remove_mirror(mirror)
+                elif op == 'move':
+                    x, pos = read_number(data, pos, mirror.x)
+                    y, pos = read_number(data, pos, mirror.y)
+                    sim.move_mirror(mirror, x, y)
+                else:
+                    delta, pos = read_number(data, pos)
+                    sim.rotate_mirror(mirror, delta)
+            elif op in ('rays', 'spread', 'dense', 'beam_rays'):
+                value, pos = read_number(data, pos)
+                {'rays': sim.set_num_rays, 'spread': sim.set_spread,
+                 'dense': lambda v: sim.set_dense(bool(v)), 'beam_rays': sim.set_beam_rays}[op](value)
+            elif op == 'clear':
+                sim.clear_mirrors()
+            elif op == 'restart':
+                sim.restart()
+            elif op == 'next':
+                sim.next_level()
+            elif op == 'release':
+                level = sim.level
+                if sim.release():
+                    completions.append({'level': level.level_num, 'score': level.score,
+                                        'time': round(sim.steps * SIM_STEP, 3)})
+    except (IndexError, struct.error):
+        raise ValueError(f"{path} 在偏移 {pos} 附近被截断或已损坏") from None
+    elapsed = time.perf_counter() - started
+    return {
+        'file': path,
+        'complete': op == 'end',
+        'level': sim.current_level,
+        'total_score': sim.total_score,
+        'completions': completions,
+        'game_seconds': round(sim.steps * SIM_STEP, 3),
+        'replay_seconds': round(elapsed, 4),
+    }
+
+def replay_summary(path):
+    """供进程池调用: 回放失败时把原因写进结果, 不让一个坏文件中断整批"""
+    try:
+        return replay_file(path)
+    except (OSError, ValueError) as exc:
+        return {'file': path, 'error': str(exc)}
+
+def replay_command(args):
+    from concurrent.futures import ProcessPoolExecutor
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(replay_summary, args.files))
+    for result in results:
+        if 'error' in result:
+            print(f"{result['file']}: 错误: {result['error']}")
+            continue
+        speed = result['game_seconds'] / result['replay_seconds'] if result['replay_seconds'] else math.inf
+        levels = ' '.join(str(c['level']) for c in result['completions']) or '无'
+        print(f"{result['file']}: 总分 {result['total_score']}, 过关 {levels}, 停在第 {result['level']} 关, "
+              f"游戏 {result['game_seconds']:.0f} 秒, 回放 {speed:.0f} 倍速"
+              + ("" if result['complete'] else " (录像不完整)"))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+    return 1 if any('error' in r for r in results) else 0
+
+def clamp_number(value, low=-math.inf, high=math.inf):
+    """把外部传来的数转成浮点数并限制在 [low, high]; NaN、无穷大或不是数时抛出 ValueError/TypeError"""
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"不是有限的数: {value}")
+    return min(high, max(low, value))
+
+class Session:
+    """服务器上的一局游戏: 一个 Simulation 和它的客户端连接
+
+    客户端发来的操作先放进 inbox, 只在本局的 tick 中执行, 所以追踪在线程池里进行时场景不会被改动.
+    每次 tick 把当前状态与上次发出的比较, 只发送变化的部分 (见 diff).
+    """
+    def __init__(self, session_id, writer, levels):
+        self.id = session_id
+        self.writer = writer
+        self.sim = Simulation(1, levels=levels, workers=1)  # 服务器已经在线程池里并行各局, 不再按光源分线程
+        self.inbox = deque()
+        self.sent = {}  # 上次发给客户端的各项状态
+        self.sent_level = None
+        self.bytes_sent = 0
+
+    def send(self, message):
+        data = (json.dumps(message, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        self.bytes_sent += len(data)
+        self.writer.write(data)
+
+    def mirror(self, message):
+        i = message['mirror']
+        if not isinstance(i, int) or not 0 <= i < len(self.sim.devices):
+            raise ValueError(f"没有第 {i} 面镜子")
+        return self.sim.devices[i]
+
+    def apply(self, message):
+        """执行一条客户端操作; 缺参数或参数不对时抛出 KeyError/TypeError/ValueError
+
+        坐标限制在场景内, 光线数和角度限制在与键盘操作相同的范围内.
+        """
+        sim = self.sim
+        op = message.get('op')
+        if op == 'add':
+            sim.add_mirror(clamp_number(message['x'], TOOLBAR_WIDTH, WIDTH), clamp_number(message['y'], 0, HEIGHT),
+                           clamp_number(message.get('angle', 0)))
+        elif op == 'move':
+            sim.move_mirror(self.mirror(message), clamp_number(message['x'], TOOLBAR_WIDTH, WIDTH),
+                            clamp_number(message['y'], 0, HEIGHT))
+        elif op == 'rotate':
+            sim.rotate_mirror(self.mirror(message), clamp_number(message['delta']))
+        elif op == 'remove':
+            sim.remove_mirror(self.mirror(message))
+        elif op == 'copy':
+            sim.copy_mirror(self.mirror(message))
+        elif op == 'rays':
+            sim.set_num_rays(int(clamp_number(message['value'], 1, 10)))
+        elif op == 'spread':
+            sim.set_spread(clamp_number(message['value'], 5, 90))
+        elif op == 'clear':
+            sim.clear_mirrors()
+        elif op == 'restart':
+            sim.restart()
+        elif op == 'next':
+            sim.next_level()
+        elif op == 'release':
+            sim.release()
+        else:
+            raise ValueError(f"未知的操作 {op!r}")
+
+    def diff(self):
+        """与上次发出的状态相比变化了的部分; 换关时先发整个关卡, 之后的各项都重新发送
+
+        光线按下标只发送变化了的 (各光源的光线依次排列), 坐标取整; ray_count 为当前光线数, 多出的旧光线由客户端删掉.
+        """
+        sim = self.sim
+        message = {}
+        if sim.level is not self.sent_level:
+            self.sent_level = sim.level
+            self.sent = {}
+            message['level'] = dict(sim.level.to_dict(), number=sim.current_level)
+        version = tuple(light.version for light in sim.lights)
+        if version != self.sent.get('version'):
+            self.sent['version'] = version
+            rays = [[[round(x), round(y)] for x, y in ray] for light in sim.lights for ray in light.rays]
+            old = self.sent.get('rays', [])
+            changed = {str(i): ray for i, ray in enumerate(rays) if i >= len(old) or old[i] != ray}
+            if changed or len(rays) != len(old):
+                message['rays'] = changed
+                message['ray_count'] = len(rays)
+            self.sent['rays'] = rays
+        for key, value in (('hits', [int(t.hit) for t in sim.level.targets]),
+                           ('movers', [[round(t.x), round(t.y)] for t in sim.movers]),
+                           ('mirrors', [[m.x, m.y, m.angle] for m in sim.devices]),
+                           ('time', int(sim.time_left)),
+                           ('score', sim.total_score)):
+            if self.sent.get(key) != value:
+                self.sent[key] = value
+                message[key] = value
+        return message
+
+class GameServer:
+    """多局游戏服务器: 一个 asyncio 事件循环里跑任意多局, 每局有自己的 tick 任务
+
+    协议是每行一个 JSON: 客户端发 {"op": ...} 操作, 服务器推送 Session.diff 的结果 (带模拟步数 t).
+    追踪放在线程池里执行, 事件循环在此期间继续处理其他局的读写和 tick, 一局算得慢只会让它自己的
+    tick 推迟. 线程池换来的是事件循环不被追踪卡住, 而不是多核加速: 各局光线数限制在 1-10,
+    低于 BATCH_MIN_RAYS, 走的是纯 Python 逐条追踪, 执行时一直持有 GIL.
+    {"op": "ping", "id": ...} 不经过 tick 立即回复 {"pong": id}, 可以用来测事件循环的响应延迟.
+    """
+    def __init__(self, levels=None, workers=None, tick=SERVER_TICK):
+        from concurrent.futures import ThreadPoolExecutor
+        self.levels = levels or BUILTIN_LEVELS
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.tick = tick
+        self.sessions = {}
+        self.next_id = 1
+
+    async def handle(self, reader, writer):
+        import asyncio
+        session = Session(self.next_id, writer, self.levels)
+        self.next_id += 1
+        self.sessions[session.id] = session
+        ticker = asyncio.create_task(self.run_session(session))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError("消息必须是 JSON 对象")
+                except ValueError as exc:
+                    session.send({'error': f"无法解析的消息: {exc}"})
+                    continue
+                if message.get('op') == 'ping':
+                    session.send({'pong': message.get('id')})
+                else:
+                    session.inbox.append(message)
+        except ConnectionError:
+            pass
+        finally:
+            ticker.cancel()
+            del self.sessions[session.id]
+            writer.close()
+
+    async def run_session(self, session):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        sim = session.sim
+        session.send({'session': session.id})
+        last = next_tick = loop.time()
+        try:
+            while True:
+                next_tick += self.tick
+                delay = next_tick - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    next_tick = loop.time()  # 落后时不连续补拍, 多出的时间由 advance 按固定步长补算
+                while session.inbox:
+                    message = session.inbox.popleft()
+                    try:
+                        session.apply(message)
+                    except (KeyError, TypeError, ValueError) as exc:
+                        session.send({'error': f"{message.get('op')}: {exc}"})
+                    except Exception as exc:  # 意外的错误只作废这一条操作, 不让本局的 tick 停掉
+                        print(f"第 {session.id} 局执行 {message!r} 出错: {exc!r}", file=sys.stderr)
+                        session.send({'error': f"{message.get('op')}: 服务器内部错误 {type(exc).__name__}"})
+                now = loop.time()
+                sim.advance(now - last)
+                last = now
+                await loop.run_in_executor(self.pool, sim.trace)
+                message = session.diff()
+                if message:
+                    message['t'] = sim.steps
+                    session.send(message)
+                await session.writer.drain()
+        except ConnectionError:
+            pass
+
+async def start_server(host='127.0.0.1', port=SERVER_PORT, levels=None, workers=None):
+    """启动服务器, 返回 (GameServer, asyncio.Server); port 为 0 时由系统分配"""
+    import asyncio
+    game = GameServer(levels, workers)
+    server = await asyncio.start_server(game.handle, host, port)
+    return game, server
+
+async def load_client(host, port, seconds, seed):
+    """压测用的替身客户端: 模拟一个学生随机放镜子、拖动、旋转、换关, 同时测 ping 往返延迟"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    stats = {'updates': 0, 'bytes': 0, 'errors': 0, 'pings': []}
+    state = {'mirrors': 0}
+    sent_at = {}
+
+    async def receive():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            stats['bytes'] += len(line)
+            message = json.loads(line)
+            if 'pong' in message:
+                stats['pings'].append((loop.time() - sent_at.pop(message['pong'])) * 1000)
+            elif 'error' in message:
+                stats['errors'] += 1
+            elif 't' in message:
+                stats['updates'] += 1
+                if 'mirrors' in message:
+                    state['mirrors'] = len(message['mirrors'])
+
+    def send(message):
+        writer.write((json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8'))
+
+    receiver = asyncio.create_task(receive())
+    deadline = loop.time() + seconds
+    ping = 0
+    while loop.time() < deadline:
+        await asyncio.sleep(LOAD_ACTION_INTERVAL * rng.uniform(0.5, 1.5))
+        action = rng.random()
+        if state['mirrors'] == 0 or action < 0.15:
+            send({'op': 'add', 'x': rng.randrange(TOOLBAR_WIDTH, WIDTH), 'y': rng.randrange(HEIGHT),
+                  'angle': rng.randrange(0, 180, 15)})
+        elif action < 0.7:
+            send({'op': 'move', 'mirror': rng.randrange(state['mirrors']),
+                  'x': rng.randrange(TOOLBAR_WIDTH, WIDTH), 'y': rng.randrange(HEIGHT)})
+        elif action < 0.9:
+            send({'op': 'rotate', 'mirror': rng.randrange(state['mirrors']), 'delta': rng.choice((-15, 15))})
+        elif action < 0.97:
+            send({'op': 'release'})
+        else:
+            send({'op': 'next'})
+        sent_at[ping] = loop.time()
+        send({'op': 'ping', 'id': ping})
+        ping += 1
+        await writer.drain()
+    receiver.cancel()
+    writer.close()
+    return stats
+
+async def load_test(args):
+    import asyncio
+    server = None
+    host, port = args.host, args.port
+    if port is None:
+        game, server = await start_server(host, 0, open_levels(args.level_file), args.workers)
+        port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(load_client(host, port, args.seconds, args.seed + i)
+                                     for i in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    pings = sorted(p for r in results for p in r['pings'])
+    total_bytes = sum(r['bytes'] for r in results)
+    print(f"{args.clients} 个客户端, {elapsed:.1f} 秒")
+    print(f"状态推送 {sum(r['updates'] for r in results)} 条, {total_bytes / elapsed / 1024:.1f} KB/s, "
+          f"错误 {sum(r['errors'] for r in results)} 条")
+    if pings:
+        p50, p95, p99 = (pings[round(p / 100 * (len(pings) - 1))] for p in (50, 95, 99))
+        print(f"ping 往返: p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, 最大 {pings[-1]:.1f} ms")
+
+async def serve_forever(args):
+    game, server = await start_server(args.host, args.port, open_levels(args.level_file), args.workers)
+    print(f"服务器已启动: {args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+def serve_command(args):
+    import asyncio
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+def load_test_command(args):
+    import asyncio
+    asyncio.run(load_test(args))
+
+def solution_score(sim):
+    """局部搜索的评分: 先比命中的目标数, 再比未命中目标离最近光线的距离之和 (越近越好)"""
+    hit = 0
+    gap = 0.0
+    for target in sim.level.targets:
+        if target.hit:
+            hit += 1
+            continue
+        best = math.inf
+        for record in (record for light in sim.lights for record in light.paths):
+            for p0, p1 in record.segments:
+                best = min(best, point_segment_distance((target.x, target.y), p0, p1) - target.radius)
+        gap += max(best, 0)
+    return hit, -gap
+
+def random_ray_point(sim, rng):
+    """当前某条光线上随机一点 (对齐到 SOLVER_GRID), 镜子放在这里才能改变光路"""
+    for _ in range(10):
+        record = rng.choice(rng.choice(sim.lights).paths)
+        if not record.segments:
+            break
+        (x0, y0), (x1, y1) = rng.choice(record.segments)
+        t = rng.uniform(0.05, 0.95)
+        x = round((x0 + (x1 - x0)*t) / SOLVER_GRID) * SOLVER_GRID
+        y = round((y0 + (y1 - y0)*t) / SOLVER_GRID) * SOLVER_GRID
+        if TOOLBAR_WIDTH <= x <= WIDTH and 0 <= y <= HEIGHT:
+            return x, y
+    return (rng.randrange(TOOLBAR_WIDTH, WIDTH + 1, SOLVER_GRID), rng.randrange(0, HEIGHT + 1, SOLVER_GRID))
+
+def mirror_layout(sim):
+    return [(m.x, m.y, m.angle % 180) for m in sim.devices]
+
+def search_mirrors(level_num, count, seed, seconds, levels_path=None):
+    """在 seconds 秒内为关卡找一种用 count 面镜子照亮全部目标的摆法
+
+    随机把镜子放到当前光路上, 再逐面镜子移动或旋转 SOLVER_ANGLE_STEP 做爬山搜索,
+    长时间没有改进就重新放置. 每走一步都用 check_completion 检查, 一旦过关立即返回
+    [(x, y, 角度), ...]; 超时返回 None. 移动目标按关卡开始时的位置计算.
+    """
+    rng = random.Random(seed)
+    deadline = time.perf_counter() + seconds
+    sim = Simulation(level_num, levels=open_levels(levels_path))
+    while True:
+        sim.clear_mirrors()
+        sim.trace()
+        for _ in range(count):
+            x, y = random_ray_point(sim, rng)
+            sim.add_mirror(x, y, rng.randrange(0, 180, SOLVER_ANGLE_STEP))
+            sim.trace()
+        if sim.level.check_completion():
+            return mirror_layout(sim)
+        if not count:
+            return None
+
+        score = solution_score(sim)
+        stale = 0
+        while stale < SOLVER_PATIENCE and time.perf_counter() < deadline:
+            mirror = rng.choice(sim.devices)
+            old_x, old_y, old_angle = mirror.x, mirror.y, mirror.angle
+            move = rng.random()
+            if move < 0.4:
+                sim.rotate_mirror(mirror, rng.choice((-1, 1)) * SOLVER_ANGLE_STEP)
+            elif move < 0.8:
+                dx = rng.randint(-5, 5) * SOLVER_GRID
+                dy = rng.randint(-5, 5) * SOLVER_GRID
+                sim.move_mirror(mirror, min(WIDTH, max(TOOLBAR_WIDTH, old_x + dx)),
+                                min(HEIGHT, max(0, old_y + dy)))
+            else:
+                sim.move_mirror(mirror, *random_ray_point(sim, rng))
+            sim.trace()
+            if sim.level.check_completion():
+                return mirror_layout(sim)
+
+            new_score = solution_score(sim)
+            if new_score >= score:
+                stale = 0 if new_score > score else stale + 1
+                score = new_score
+            else:
+                sim.move_mirror(mirror, old_x, old_y)
+                sim.rotate_mirror(mirror, old_angle - mirror.angle)
+                sim.trace()
+                stale += 1
+        if time.perf_counter() >= deadline:
+            return None
+
+def solve_level(level_num, pool, workers, seconds=SOLVER_COUNT_SECONDS, seed=0, levels_path=None):
+    """从 0 面镜子开始逐个增加, 返回 (最少镜子数, 摆法); 上限内都没找到返回 (None, None)
+
+    每个镜子数最多搜索 seconds 秒, 由 workers 个进程各自从不同随机种子搜索,
+    按 SOLVER_CHUNK_SECONDS 分段提交, 任一进程找到解就不再提交新任务.
+    较少镜子数没找到只说明在时限内没搜到, 不是不可解的证明.
+    """
+    from concurrent.futures import as_completed
+    level = open_levels(levels_path).level(level_num)
+    for count in range(level.mirror_limit + 1):
+        if count == 0:
+            layout = search_mirrors(level_num, 0, seed, 0, levels_path)
+            if layout is not None:
+                return 0, layout
+            continue
+        deadline = time.perf_counter() + seconds
+        round_num = 0
+        while time.perf_counter() < deadline:
+            chunk = min(SOLVER_CHUNK_SECONDS, deadline - time.perf_counter())
+            futures = [pool.submit(search_mirrors, level_num, count,
+                                   hash((seed, count, round_num, worker)), chunk, levels_path)
+                       for worker in range(workers)]
+            for future in as_completed(futures):
+                layout = future.result()
+                if layout is not None:
+                    for other in futures:
+                        other.cancel()
+                    return count, layout
+            round_num += 1
+    return None, None
+
+def solve_command(args):
+    from concurrent.futures import ProcessPoolExecutor
+    pack = open_levels(args.level_file)
+    levels = args.levels or list(range(1, len(pack) + 1))
+    missing = [level_num for level_num in levels if not 1 <= level_num <= len(pack)]
+    if missing:
+        print(f"没有第 {', '.join(map(str, missing))} 关 (共 {len(pack)} 关)", file=sys.stderr)
+        return 1
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for level_num in levels:
+            start = time.perf_counter()
+            count, layout = solve_level(level_num, pool, workers, args.seconds, args.seed, args.level_file)
+            elapsed = time.perf_counter() - start
+            limit = pack.level(level_num).mirror_limit
+            if count is None:
+                print(f"关卡 {level_num}: 上限 {limit} 面镜子内未找到解 (每个镜子数搜索 {args.seconds:g} 秒)")
+                continue
+            print(f"关卡 {level_num}: 最少 {count} 面镜子 (上限 {limit}), 用时 {elapsed:.1f} 秒")
+            for x, y, angle in layout:
+                print(f"    镜子 x={x:g} y={y:g} 角度={angle:g}")
+
+def export_levels_command(args):
+    """把关卡 (默认内置关卡) 写成关卡包, 可以作为老师编写新关卡的模板"""
+    pack = open_levels(args.level_file)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for level_num in range(1, len(pack) + 1):
+            f.write(json.dumps(pack.level(level_num).to_dict(), ensure_ascii=False) + '\n')
+    print(f"已导出 {len(pack)} 个关卡到 {args.output}")
+
+class Grader:
+    """批改镜子摆法作业
+
+    每份作业是一个 JSON 对象: {"id": 学生, "level": 关卡, "mirrors": [[x, y, 角度], ...]},
+    可选 time_left (剩余秒数, 计入时间奖励, 默认 0) 以及第一个光源的 rays 和 spread.
+    数值都必须是有限的数, 镜子必须在场景内; 给出的 rays、spread 限制在与键盘操作相同的范围,
+    time_left 限制在 0 到本关时限之间.
+    每关只构造一个 Simulation, 每份作业清空镜子重新摆放后追踪一次, 用 check_completion 判定、
+    calculate_score 计分; 移动目标按关卡开始时的位置计算. 作业先整体检查, 通过后才改动 Simulation.
+    """
+    def __init__(self, levels_path=None):
+        self.levels = open_levels(levels_path)
+        self.sims = {}  # 关卡编号 -> (Simulation, 第一个光源的默认光线数和角度)
+
+    def sim(self, level_num):
+        # 先检查再查缓存: true 和 1.0 与 1 相等, 会直接命中第 1 关的缓存
+        if isinstance(level_num, bool) or not isinstance(level_num, int) or not 1 <= level_num <= len(self.levels):
+            raise ValueError(f"没有第 {level_num!r} 关")
+        if level_num not in self.sims:
+            sim = Simulation(level_num, levels=self.levels, workers=1)
+            self.sims[level_num] = sim, (sim.light.num_rays, sim.light.spread)
+        return self.sims[level_num]
+
+    @staticmethod
+    def number(value, name, low=-math.inf, high=math.inf):
+        """作业中的一个数: 必须是 JSON 数字且有限, 再限制在 [low, high]"""
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(f"{name} 应为数字, 而不是 {value!r}")
+        return clamp_number(value, low, high)
+
+    def grade(self, submission):
+        sim, (num_rays, spread) = self.sim(submission['level'])
+        level = sim.level
+        mirrors = submission['mirrors']
+        if not isinstance(mirrors, list):
+            raise TypeError("mirrors 应为列表")
+        if len(mirrors) > level.mirror_limit:
+            raise ValueError(f"用了 {len(mirrors)} 面镜子, 超过本关上限 {level.mirror_limit}")
+        layout = []
+        for i, mirror in enumerate(mirrors):
+            if not isinstance(mirror, list) or len(mirror) != 3:
+                raise ValueError(f"第 {i + 1} 面镜子应为 [x, y, 角度]")
+            x, y, angle = (self.number(v, f"第 {i + 1} 面镜子的{name}") for v, name in zip(mirror, ('x', 'y', '角度')))
+            if not (TOOLBAR_WIDTH <= x <= WIDTH and 0 <= y <= HEIGHT):
+                raise ValueError(f"第 {i + 1} 面镜子 ({x:g}, {y:g}) 不在场景内")
+            layout.append((x, y, angle))
+        rays = int(self.number(submission['rays'], 'rays', 1, 10)) if 'rays' in submission else num_rays
+        beam = self.number(submission['spread'], 'spread', 5, 90) if 'spread' in submission else spread
+        time_left = self.number(submission.get('time_left', 0), 'time_left', 0, level.time_limit)
+
+        sim.clear_mirrors()
+        sim.set_num_rays(rays)
+        sim.set_spread(beam)
+        for x, y, angle in layout:
+            sim.add_mirror(x, y, angle)
+        sim.trace()
+        completed = level.check_completion()
+        return {'level': level.level_num, 'mirrors': len(layout),
+                'hit': sum(t.hit for t in level.targets), 'targets': len(level.targets), 'completed': completed,
+                'score': level.calculate_score(len(layout), time_left) if completed else 0}
+
+def grade_chunk(first_line, lines, levels_path=None):
+    """供进程池调用: 批改一段作业文件的各行; 格式不对的作业把原因写进结果, 不中断整批"""
+    grader = Grader(levels_path)
+    results = []
+    for number, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        result = {'line': number}
+        try:
+            submission = json.loads(line)
+            result['id'] = submission.get('id')
+            result['level'] = submission.get('level')
+            result.update(grader.grade(submission))
+        except (ValueError, TypeError, KeyError, AttributeError, OverflowError) as exc:
+            result['error'] = f"{type(exc).__name__}: {exc}"
+        results.append(result)
+    return results
+
+def read_chunks(path, size=GRADE_CHUNK):
+    """逐段读出文件, 每次给出 (第一行的行号, 不超过 size 行), 不把整个文件读进内存"""
+    with open(path, encoding='utf-8') as f:
+        lines = []
+        first = 1
+        for number, line in enumerate(f, 1):
+            lines.append(line)
+            if len(lines) == size:
+                yield first, lines
+                lines = []
+                first = number + 1
+        if lines:
+            yield first, lines
+
+def grade_command(args):
+    """批改作业文件 (JSON Lines, 每行一份, 见 Grader), 结果按行号顺序写成 CSV 或 JSON 报告
+
+    文件分段交给进程池, 同时在途的段数有限, 结果边算边写, 内存占用与作业份数无关.
+    """
+    import csv
+    from concurrent.futures import ProcessPoolExecutor
+    workers = args.workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    count = passed = errors = 0
+    as_csv = args.output.lower().endswith('.csv')
+    with open(args.output, 'w', encoding='utf-8', newline='') as out, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        if as_csv:
+            writer = csv.DictWriter(out, GRADE_FIELDS)
+            writer.writeheader()
+        else:
+            out.write('[')
+        pending = deque()
+        chunks = read_chunks(args.submissions)
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.submit(grade_chunk, *chunk, args.level_file))
+            if not pending:
+                break
+            for result in pending.popleft().result():
+                if as_csv:
+                    writer.writerow(result)
+                else:
+                    out.write((',\n' if count else '\n') + json.dumps(result, ensure_ascii=False))
+                count += 1
+                passed += bool(result.get('completed'))
+                errors += 'error' in result
+        if not as_csv:
+            out.write('\n]\n')
+    elapsed = time.perf_counter() - started
+    print(f"批改 {count} 份作业, 过关 {passed} 份, 出错 {errors} 份, 用时 {elapsed:.1f} 秒 "
+          f"({count / elapsed if elapsed else math.inf:.0f} 份/秒), 报告已写入 {args.output}")
+    return 1 if errors else 0
+
+def random_level(seed, targets=3, obstacles=0):
+    """按种子生成的随机关卡, 基准测试用; 镜子数不设上限"""
+    rng = random.Random(seed)
+    level = GameLevel(0)
+    for _ in range(targets):
+        level.targets.append(Target(rng.randrange(TOOLBAR_WIDTH + 100, WIDTH - 30), rng.randrange(30, HEIGHT - 30)))
+    for _ in range(obstacles):
+        level.obstacles.append(Obstacle(rng.randrange(TOOLBAR_WIDTH + 100, WIDTH - 40), rng.randrange(0, HEIGHT - 40),
+                                        rng.randrange(10, 40), rng.randrange(10, 40)))
+    return level
+
+def bench_scenes(seed):
+    """基准场景: 五个内置关卡 (镜子放满上限) 和几种规模的随机场景, 返回 [(名字, Simulation)]"""
+    rng = random.Random(seed)
+    specs = [(f"level{n}", GameLevel(n), GameLevel(n).mirror_limit) for n in range(1, LEVEL_COUNT + 1)]
+    specs += [("random10", random_level(seed, 3), 10),
+              ("random40", random_level(seed + 1, 6), 40),
+              ("maze", random_level(seed + 2, 6, 120), 40)]
+    scenes = []
+    for name, level, mirrors in specs:
+        sim = Simulation()
+        sim.use_level(level)
+        for _ in range(mirrors):
+            sim.add_mirror(rng.randrange(TOOLBAR_WIDTH + 50, WIDTH), rng.randrange(0, HEIGHT), rng.uniform(0, 180))
+        sim.trace()
+        scenes.append((name, sim))
+    return scenes
+
+def measure(fn, repeat=BENCH_REPEAT):
+    """多轮计时, 返回每次调用的耗时统计 (毫秒)"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= BENCH_TARGET_SECONDS or number >= 1 << 16:
+            break
+        number *= 2
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) * 1000 / number)
+    return time_stats(times, number * repeat)
+
+def time_stats(times, calls):
+    """每轮耗时 (毫秒) 的统计"""
+    times = sorted(times)
+    return {'min_ms': times[0], 'median_ms': times[len(times) // 2],
+            'mean_ms': sum(times) / len(times), 'calls': calls}
+
+def bench_startup(repeat):
+    """冷启动: 每轮在新进程里运行 play --first-frame
+
+    process 为整个进程从启动到退出的时间, first-frame 为游戏自己报告的从脚本开始加载到第一帧画出的时间.
+    没有设置 SDL_VIDEODRIVER 时用 dummy 驱动, 不弹出窗口.
+    """
+    import subprocess
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1')
+    env.setdefault('SDL_VIDEODRIVER', 'dummy')
+    process, first = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), 'play', '--first-frame'],
+                                env=env, capture_output=True, text=True, encoding='utf-8', check=True).stdout
+        process.append((time.perf_counter() - start) * 1000)
+        first.append(float(output.split("首帧:")[1].split()[0]))
+    return [dict(group='startup', scene='level1', mode='process', **time_stats(process, repeat)),
+            dict(group='startup', scene='level1', mode='first-frame', **time_stats(first, repeat))]
+
+def bench_trace(scenes, ray_counts, bounce_depths, repeat):
+    results = []
+    for name, sim in scenes:
+        light = sim.light
+        devices = sim.devices + sim.level.obstacles
+        targets = sim.static_targets
+        for num_rays in ray_counts:
+            light.num_rays = num_rays
+            angles = light.ray_angles()
+            starts = [(light.x, light.y)] * num_rays
+            for bounces in bounce_depths:
+                stats = measure(lambda: light.trace_rays_raw(starts, angles, devices, targets, bounces, sim.index), repeat)
+                results.append(dict(group='trace', scene=name, rays=num_rays, bounces=bounces, **stats))
+        light.num_rays = 3
+        sim.mark_dirty()
+    return results
+
+def bench_drag(scenes, num_rays, repeat):
+    """拖动一面镜子后的增量重算 (Simulation.trace → update_rays)"""
+    results = []
+    for name, sim in scenes:
+        if not sim.devices:
+            continue
+        sim.set_num_rays(num_rays)
+        sim.trace()
+        mirror = sim.devices[0]
+        x, y = mirror.x, mirror.y
+        offsets = [(dx, dy) for dx in (-20, 0, 20) for dy in (-20, 20)]
+        state = {'i': 0}
+        def drag():
+            dx, dy = offsets[state['i'] % len(offsets)]
+            state['i'] += 1
+            sim.move_mirror(mirror, x + dx, y + dy)
+            sim.trace()
+        results.append(dict(group='drag', scene=name, rays=num_rays, **measure(drag, repeat)))
+        sim.move_mirror(mirror, x, y)
+        sim.set_num_rays(3)
+        sim.trace()
+    return results
+
+def bench_pick(scenes, seed, repeat):
+    """每次调用拾取 100 个随机点, 结果换算成单次拾取"""
+    rng = random.Random(seed)
+    points = [(rng.randrange(TOOLBAR_WIDTH, WIDTH), rng.randrange(0, HEIGHT)) for _ in range(100)]
+    results = []
+    for name, sim in scenes:
+        def pick():
+            for x, y in points:
+                sim.pick(x, y)
+        stats = measure(pick, repeat)
+        stats = {k: v / len(points) if k.endswith('_ms') else v for k, v in stats.items()}
+        results.append(dict(group='pick', scene=name, **stats))
+    return results
+
+def bench_render(scenes, repeat):
+    """画到离屏表面: full 每次重建静态层并整屏重画, drag 为拖动一面镜子时的脏矩形重画"""
+    load_pygame()
+    pygame.font.init()
+    font, small_font = make_fonts()
+    buttons = (pygame.Rect(20, 120, 110, 40), pygame.Rect(20, 180, 110, 40), pygame.Rect(20, 240, 110, 40))
+    results = []
+    for name, sim in scenes:
+        renderer = Renderer(pygame.Surface((WIDTH, HEIGHT)), font, small_font, buttons)
+        def full():
+            renderer.static_level = None
+            renderer.draw(sim, 0)
+        results.append(dict(group='render', scene=name, mode='full', **measure(full, repeat)))
+        if not sim.devices:
+            continue
+        mirror = sim.devices[0]
+        x, y = mirror.x, mirror.y
+        state = {'i': 0}
+        def drag():
+            state['i'] += 1
+            sim.move_mirror(mirror, x + state['i'] % 2 * 20, y)
+            sim.trace()
+            renderer.draw(sim, 0)
+        results.append(dict(group='render', scene=name, mode='drag', **measure(drag, repeat)))
+        sim.move_mirror(mirror, x, y)
+        sim.trace()
+    return results
+
+def bench_lights(scenes, source_counts, num_rays, repeat):
+    """多个光源同时整体重算: 每个光源 num_rays 条光线, 串行与线程池并行对比
+
+    update 为 Simulation.trace 的完整重算 (含路径缓存的构建, threads 时 PathTable.trace 整个进线程池),
+    kernel 只计 trace_batch_arrays 本身 (需要 NumPy). threads 的结果带 speedup, 即同一场景串行与并行
+    最快一轮之比; 单核机器上它不会超过 1.
+    """
+    results = []
+    for name, scene in scenes:
+        if name not in ('random40', 'maze'):
+            continue
+        data = scene.level.to_dict()
+        for sources in source_counts:
+            data['lights'] = [{'x': TOOLBAR_WIDTH + 20, 'y': HEIGHT * (i + 1) // (sources + 1), 'num_rays': num_rays}
+                              for i in range(sources)]
+            level = GameLevel(1, data)
+            serial = {}
+            for mode, workers in (('serial', 1), ('threads', sources))[:1 if sources == 1 else 2]:
+                sim = Simulation(workers=workers)
+                sim.use_level(level)
+                for mirror in scene.devices:
+                    sim.add_mirror(mirror.x, mirror.y, mirror.angle)
+                def update():
+                    sim.mark_dirty()
+                    sim.trace()
+                stats = measure(update, repeat)
+                serial.setdefault('update', stats['min_ms'])
+                results.append(dict(group='lights', scene=name, mode=f'update-{mode}', sources=sources,
+                                    rays=num_rays, **stats, speedup=serial['update'] / stats['min_ms']))
+                if np is None:
+                    continue
+                mirrors = sim.devices
+                obstacles = sim.level.obstacles
+                arrays = scene_arrays(sim.index, mirrors, sim.static_targets, obstacles)
+                def kernel(light):
+                    trace_batch_arrays((light.x, light.y), light.ray_angles(), mirrors,
+                                       sim.static_targets, MAX_BOUNCES, obstacles, arrays)
+                if workers > 1:
+                    from concurrent.futures import ThreadPoolExecutor
+                    with ThreadPoolExecutor(max_workers=workers) as pool:
+                        stats = measure(lambda: list(pool.map(kernel, sim.lights)), repeat)
+                else:
+                    stats = measure(lambda: [kernel(light) for light in sim.lights], repeat)
+                serial.setdefault('kernel', stats['min_ms'])
+                results.append(dict(group='lights', scene=name, mode=f'kernel-{mode}', sources=sources,
+                                    rays=num_rays, **stats, speedup=serial['kernel'] / stats['min_ms']))
+                if sim.pool is not None:
+                    sim.pool.shutdown()
+    return results
+
+def bench_key(result):
+    """结果的唯一名字, 对比两次运行时按它配对, 如 trace/level3/rays=30/bounces=5"""
+    parts = [result['group'], result['scene']]
+    parts += [f"{k}={result[k]}" for k in ('mode', 'sources', 'rays', 'bounces') if k in result]
+    return '/'.join(parts)
+
+def bench_command(args):
+    repeat = args.repeat
+    scenes = bench_scenes(args.seed)
+    if args.quick:
+        ray_counts, bounce_depths = (3, 100), (MAX_BOUNCES,)
+    else:
+        ray_counts, bounce_depths = (3, 30, 300, 1000), (1, MAX_BOUNCES, 10)
+    results = bench_trace(scenes, ray_counts, bounce_depths, repeat)
+    results += bench_drag(scenes, 30, repeat)
+    results += bench_pick(scenes, args.seed, repeat)
+    results += bench_render(scenes, repeat)
+    results += bench_startup(repeat)
+    results += bench_lights(scenes, (1, 4) if args.quick else (1, 4, 8), 300 if args.quick else 1000, repeat)
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__ if np is not None else None,
+            'pygame': pygame.version.ver,
+            'seed': args.seed,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+    for result in results:
+        speedup = f"  x{result['speedup']:.2f}" if result.get('speedup', 1) != 1 else ""
+        print(f"{bench_key(result):55s} {result['median_ms']:9.3f} ms{speedup}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = {bench_key(r): r for r in json.load(f)['results']}
+        slower = []
+        for result in results:
+            old = baseline.get(bench_key(result))
+            # 用最快一轮比较, 受其他进程干扰最小
+            if old and old['min_ms'] > 0:
+                ratio = result['min_ms'] / old['min_ms']
+                if ratio > BENCH_REGRESSION:
+                    slower.append((bench_key(result), old['min_ms'], result['min_ms'], ratio))
+        for key, old_ms, new_ms, ratio in slower:
+            print(f"变慢: {key} {old_ms:.3f} -> {new_ms:.3f} ms (x{ratio:.2f})")
+        return 1 if slower else 0
+    return 0
+
+class TextCache:
+    """按 (字体, 文字, 颜色) 缓存渲染好的文字表面"""
+    def __init__(self, limit=TEXT_CACHE_LIMIT):
+        self.limit = limit
+        self.surfaces = {}
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            PROFILER.count('text_cache_hits')
+        else:
+            if len(self.surfaces) >= self.limit:
+                self.surfaces.clear()
+            surface = self.surfaces[key] = font.render(text, True, color)
+        return surface
+
+class Renderer:
+    """分层绘制
+
+    工具栏、按钮、障碍物等静态内容每关只画一次到 background, 操作提示的文字表面预先
+    渲染好, 作为 overlay 保持在最上层. 每帧把动态内容 (文字、目标、镜子、光线) 列成元素, 元素的 key
+    没变就不重画; 变化元素的新旧区域恢复背景后, 按层次重画与之相交的元素,
+    draw 返回这些区域, 由调用者用 display.update 推送; 画到离屏表面时直接丢弃即可.
+    """
+    def __init__(self, screen, font, small_font, buttons):
+        self.screen = screen
+        self.font = font
+        self.small_font = small_font
+        self.mirror_btn, self.level_btn, self.reset_btn = buttons
+        self.text = TextCache()
+        self.background = None
+        self.overlay = None
+        self.overlay_rect = None
+        self.static_level = None
+        self.items = {}  # 元素名 -> (key, rect), 上一帧画出的内容
+        self.heatmap = None  # 打开光照热力图时为 HeatMap
+
+    def build_static(self, sim):
+        """画本关的静态背景和提示层"""
+        background = pygame.Surface((WIDTH, HEIGHT))
+        background.fill(WHITE)
+        pygame.draw.rect(background,   (240, 240, 240), (0, 0, TOOLBAR_WIDTH, HEIGHT))
+        pygame.draw.rect(background,   BLACK, (0, 0, TOOLBAR_WIDTH, HEIGHT), 2)
+        for rect, color, label, text_color in (
+                (self.mirror_btn, SILVER, " 添加镜子", BLACK),
+                (self.level_btn, BLUE, f" 关卡 {sim.current_level}/{len(sim.levels)}", WHITE),
+                (self.reset_btn, RED, " 重置关卡", WHITE)):
+            pygame.draw.rect(background, color, rect)
+            pygame.draw.rect(background, BLACK, rect, 2)
+            background.blit(self.text.render(self.small_font, label, text_color), (rect.x + 10, rect.y + 10))
+        for obstacle in sim.level.obstacles:
+            obstacle.draw(background)
+        self.background = background
+
+        # 抗锯齿文字直接画在屏幕上, 不经过透明色表面, 以免边缘发黑
+        self.overlay = [(self.text.render(self.small_font, hint, PURPLE), (WIDTH - 300, HEIGHT - 250 + i * 20))
+                        for i, hint in enumerate(HINTS)]
+        self.overlay_rect = pygame.Rect(WIDTH - 300, HEIGHT - 250, 0, 0).unionall(
+            [pygame.Rect(pos, surface.get_size()) for surface, pos in self.overlay])
+        self.static_level = sim.level
+
+    def text_item(self, name, font, text, color, pos):
+        surface = self.text.render(font, text, color)
+        rect = pygame.Rect(pos, surface.get_size())
+        return name, text, rect, lambda screen: screen.blit(surface, pos)
+
+    def hud_item(self, lines):
+        """性能面板: 浅色底板上逐行显示各阶段耗时和计数的分位数"""
+        surfaces = [self.text.render(self.small_font, line, BLACK) for line in lines]
+        x, y = TOOLBAR_WIDTH + 10, 10
+        rect = pygame.Rect(x - 5, y - 5, max(s.get_width() for s in surfaces) + 10, len(surfaces) * 20 + 10)
+        def draw(screen):
+            screen.fill((250, 250, 220), rect)
+            screen.blits([(s, (x, y + i * 20)) for i, s in enumerate(surfaces)])
+        return 'hud', tuple(lines), rect, draw
+
+    def frame_items(self, sim, now, alpha):
+        """本帧的动态元素, 按绘制层次排列: (名字, key, 区域, 绘制函数)"""
+        level = sim.level
+        light = sim.light
+        if light.dense is not None and light.dense.surface is None and light.dense.coords is not None:
+            light.dense.render()  # 渲染会更新光线数和耗时, 要在生成文字之前
+        items = [self.text_item('mirrors', self.small_font, f" 镜子: {len(sim.devices)}/{level.mirror_limit}",
+                                BLACK, (20, 80))]
+        if light.dense is not None:
+            beam = light.dense
+            items.append(self.text_item('beam_rays', self.small_font,
+                                        f" 光线: {beam.active_rays}/{beam.num_rays}", BLACK, (20, 300)))
+            items.append(self.text_item('beam_cost', self.small_font,
+                                        f" 追踪: {beam.cost_ms:.1f}ms", BLACK, (20, 325)))
+        if level.time_limit > 0:
+            items.append(self.text_item('time', self.font, f" 时间: {int(sim.time_left)}秒", BLACK, (WIDTH - 200, 20)))
+        items.append(self.text_item('score', self.font, f" 总分: {sim.total_score}", BLACK, (WIDTH - 200, 60)))
+
+        heatmap = self.heatmap
+        if heatmap is not None and heatmap.render(now) is not None:
+            items.append(('heatmap', heatmap.surface_version, pygame.Rect(TOOLBAR_WIDTH, 0, WIDTH - TOOLBAR_WIDTH, HEIGHT),
+                          lambda screen: heatmap.draw(screen, now)))
+
+        for target in level.targets:
+            r = target.radius
+            x, y = target.position(alpha)
+            rect = pygame.Rect(int(x - r) - 2, int(y - r) - 2, 2*r + 5, 2*r + 5)
+            items.append((target, (x, y, r, target.hit), rect,
+                          lambda screen, target=target: target.draw(screen, alpha)))
+
+        for device in sim.devices:
+            if isinstance(device, Mirror):
+                (x1, y1), (x2, y2) = device.get_end_points()
+                pad = MIRROR_HANDLE_SIZE + 2
+                rect = pygame.Rect(int(min(x1, x2)) - pad, int(min(y1, y2)) - pad,
+                                   int(abs(x2 - x1)) + 2*pad + 1, int(abs(y2 - y1)) + 2*pad + 1)
+                items.append((device, (device.x, device.y, device.angle, device.length), rect, device.draw))
+
+        if light.dense is not None:
+            beam = light.dense
+            if beam.surface is not None:
+                items.append(('rays', light.version, beam.rect, beam.draw))
+        for source in sim.lights:
+            if source.dense is None and source.ray_layer() is not None:
+                # 光线表面只在重新追踪后重画, 脉动只改透明度
+                key = (source.version, source.pulse_alpha(now))
+                items.append((('rays', source), key, source.ray_rect,
+                              lambda screen, source=source: source.draw(screen, now)))
+
+        if PROFILER.hud:
+            items.append(self.hud_item(PROFILER.hud_lines(now)))
+
+        overlay = self.overlay
+        items.append(('hints', None, self.overlay_rect, lambda screen: screen.blits(overlay)))
+        return items
+
+    def draw(self, sim, now, alpha=1.0):
+        """alpha 为模拟步之间的插值系数, 见 Simulation.advance"""
+        screen = self.screen
+        full = sim.level is not self.static_level
+        if full:
+            self.build_static(sim)
+            self.items = {}
+
+        items = self.frame_items(sim, now, alpha)
+        dirty = []
+        for name, key, rect, draw in items:
+            old = self.items.pop(name, None)
+            if old is None or old[0] != key:
+                if old is not None:
+                    dirty.append(old[1])
+                dirty.append(rect)
+        dirty.extend(rect for key, rect in self.items.values())  # 已经消失的元素
+        self.items = {name: (key, rect) for name, key, rect, draw in items}
+
+        if full:
+            dirty = [screen.get_rect()]
+        dirty = [rect.clip(screen.get_rect()) for rect in dirty]
+        # 被更大区域完全盖住的区域不用再画一遍
+        merged = []
+        for rect in sorted(dirty, key=lambda r: r.width * r.height, reverse=True):
+            if rect.width and rect.height and not any(big.contains(rect) for big in merged):
+                merged.append(rect)
+        dirty = merged
+        for rect in dirty:
+            screen.set_clip(rect)
+            screen.blit(self.background, rect, rect)
+            for name, key, item_rect, draw in items:
+                if item_rect.colliderect(rect):
+                    draw(screen)
+        screen.set_clip(None)
+        return dirty
+
+def make_fonts(cache_path=FONT_CACHE_PATH):
+    """游戏用的大小两种字体
+
+    SysFont 每次都要扫描一遍系统字体 (Windows 上读注册表, 其他系统运行 fc-list), 旧电脑上很慢.
+    这里把字体名解析出的文件路径存到 cache_path, 以后启动直接按路径打开; 缓存的文件不在了才重新解析.
+    系统中没有的字体记为 null, 与 SysFont 一样用 pygame 的默认字体; 新装了字体后删掉缓存文件即可.
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            paths = json.load(f)
+    except (OSError, ValueError):
+        paths = {}
+    fonts = []
+    changed = False
+    for name, size in (('SimHei', 26), ('Microsoft  YaHei', 18)):
+        path = paths.get(name)
+        if name not in paths or (path is not None and not os.path.exists(path)):
+            path = paths[name] = pygame.font.match_font(name)
+            changed = True
+        fonts.append(pygame.font.Font(path, size))
+    if changed:
+        try:
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(paths, f, ensure_ascii=False)
+        except OSError:  # 缓存写不进去只是下次还要扫描
+            pass
+    return tuple(fonts)
+
+def main(profile_trace=None, level_file=None, record=None, first_frame=False):
+    """运行游戏; first_frame 为真时画出第一帧就退出, 用来测量冷启动时间"""
+    load_pygame()
     pygame.init()   
     screen = pygame.display.set_mode((WIDTH,   HEIGHT))
     pygame.display.set_caption(" 光学实验室大冒险 - 完整版")
     clock = pygame.time.Clock()   
-    font = pygame.font.SysFont('SimHei',   26)
-    small_font = pygame.font.SysFont('Microsoft  YaHei', 18)
+    font, small_font = make_fonts()
     
-    current_level = 1 
-    level = GameLevel(current_level)
-    devices = []
-    light = LightSource(200, 400)
+    sim = Simulation(1, levels=open_levels(level_file))
+    recorder = None
+    if record:
+        sim = recorder = Recorder(sim, record, level_file)
+    light = sim.light
     selected_device = None 
     drag_offset = (0, 0)
     
-    start_time = pygame.time.get_ticks()   
-    time_left = level.time_limit    
-    total_score = 0 
-    
-    toolbar_width = 150 
+    toolbar_width = TOOLBAR_WIDTH 
     mirror_btn = pygame.Rect(20, 120, 110, 40)
     level_btn = pygame.Rect(20, 180, 110, 40)
     reset_btn = pygame.Rect(20, 240, 110, 40)
+    renderer = Renderer(screen, font, small_font, (mirror_btn, level_btn, reset_btn))
+    if profile_trace:
+        PROFILER.record_to(profile_trace)
     
+    dt = 0
+    shown = False
     running = True 
     while running:
-        if level.time_limit   > 0:
-            elapsed = (pygame.time.get_ticks()   - start_time) / 1000 
-            time_left = max(0, level.time_limit   - elapsed)
-            if time_left <= 0 and not level.completed:   
-                current_level = max(1, current_level - 1)
-                level = GameLevel(current_level)
-                devices = []
-                start_time = pygame.time.get_ticks()   
-        
-        for target in level.targets:   
-            if isinstance(target, (MovingTarget, VerticalMovingTarget, EightShapeTarget)):
-                target.update()   
-                light.update_rays(devices,   level.targets)   
-        
-        screen.fill(WHITE)   
+        frame_started = PROFILER.start()
+        started = PROFILER.start()
+        alpha = sim.advance(dt)
+        PROFILER.stop('step', started)
         
+        started = PROFILER.start()
         for event in pygame.event.get():   
             if event.type   == pygame.QUIT:
                 running = False 
@@ -401,146 +3681,157 @@ def main():
             elif event.type   == pygame.MOUSEBUTTONDOWN:
                 x, y = event.pos    
                 if x < toolbar_width:
-                    if mirror_btn.collidepoint(x,   y) and len(devices) < level.mirror_limit:   
-                        new_mirror = Mirror(WIDTH//2, HEIGHT//2)
-                        devices.append(new_mirror)   
-                        selected_device = new_mirror 
-                        drag_offset = (new_mirror.x - x, new_mirror.y - y)
-                        new_mirror.needs_update   = True 
+                    if mirror_btn.collidepoint(x,   y):
+                        new_mirror = sim.add_mirror(WIDTH//2, HEIGHT//2)
+                        if new_mirror:
+                            selected_device = new_mirror 
+                            drag_offset = (new_mirror.x - x, new_mirror.y - y)
                     elif level_btn.collidepoint(x,   y):
-                        current_level = current_level % 5 + 1 
-                        level = GameLevel(current_level)
-                        devices = []
-                        start_time = pygame.time.get_ticks()   
+                        sim.next_level()
                     elif reset_btn.collidepoint(x,   y):
-                        devices = []
-                        start_time = pygame.time.get_ticks()   
+                        sim.restart()
                 else:
-                    for device in devices:
-                        start, end = device.get_end_points()   
-                        if math.hypot(start[0]   - x, start[1] - y) < 10:
-                            device.angle   += 15 
-                            device.needs_update   = True 
-                            break 
-                        elif math.hypot(end[0]   - x, end[1] - y) < 10:
-                            device.angle   -= 15 
-                            device.needs_update   = True 
-                            break 
-                        elif math.hypot(device.x   - x, device.y - y) < 20:
-                            selected_device = device 
-                            drag_offset = (device.x - x, device.y - y)
-                            break 
+                    device, part = sim.pick(x, y)
+                    if part == 'start':
+                        sim.rotate_mirror(device, 15)
+                    elif part == 'end':
+                        sim.rotate_mirror(device, -15)
+                    elif part == 'center':
+                        selected_device = device 
+                        drag_offset = (device.x - x, device.y - y)
  
             elif event.type   == pygame.MOUSEMOTION and selected_device:
                 x, y = event.pos    
-                selected_device.move(x   + drag_offset[0], y + drag_offset[1])
+                sim.move_mirror(selected_device, x + drag_offset[0], y + drag_offset[1])
  
             elif event.type   == pygame.MOUSEBUTTONUP:
                 selected_device = None 
-                if level.check_completion():   
-                    score = level.calculate_score(len(devices),   time_left)
-                    total_score += score 
-                    current_level = current_level % 5 + 1 
-                    level = GameLevel(current_level)
-                    devices = []
-                    start_time = pygame.time.get_ticks()   
+                sim.release()
  
             elif event.type   == pygame.KEYDOWN:
-                if event.key   == pygame.K_UP and light.num_rays   < 10:
-                    light.num_rays   += 1 
-                    for device in devices:
-                        device.needs_update   = True 
+                if event.key == pygame.K_b:
+                    sim.set_dense(light.dense is None)
+                elif event.key == pygame.K_h and np is not None:
+                    renderer.heatmap = HeatMap() if renderer.heatmap is None else None
+                elif event.key == pygame.K_F3:
+                    PROFILER.set_hud(not PROFILER.hud)
+                elif light.dense is not None and event.key in (pygame.K_UP, pygame.K_DOWN):
+                    factor = 1.5 if event.key == pygame.K_UP else 1/1.5
+                    sim.set_beam_rays(light.dense.num_rays * factor)
+                elif event.key   == pygame.K_UP and light.num_rays   < 10:
+                    sim.set_num_rays(light.num_rays + 1)
                 elif event.key   == pygame.K_DOWN and light.num_rays   > 1:
-                    light.num_rays   -= 1 
-                    for device in devices:
-                        device.needs_update   = True 
+                    sim.set_num_rays(light.num_rays - 1)
                 elif event.key   == pygame.K_RIGHT and light.spread   < 90:
-                    light.spread   += 5 
-                    for device in devices:
-                        device.needs_update   = True 
+                    sim.set_spread(light.spread + 5)
                 elif event.key   == pygame.K_LEFT and light.spread   > 5:
-                    light.spread   -= 5 
-                    for device in devices:
-                        device.needs_update   = True 
+                    sim.set_spread(light.spread - 5)
                 elif event.key   == pygame.K_d and selected_device:
-                    devices.remove(selected_device)   
+                    sim.remove_mirror(selected_device)
                     selected_device = None 
-                elif event.key   == pygame.K_c and selected_device and len(devices) < level.mirror_limit:   
-                    new_mirror = Mirror(selected_device.x + 20, selected_device.y + 20)
-                    new_mirror.angle   = selected_device.angle    
-                    devices.append(new_mirror)   
+                elif event.key   == pygame.K_c and selected_device:
+                    sim.copy_mirror(selected_device)
                 elif event.key   == pygame.K_SPACE:
-                    devices = []
+                    sim.clear_mirrors()
                 elif event.key   == pygame.K_n:
-                    current_level = current_level % 5 + 1 
-                    level = GameLevel(current_level)
-                    devices = []
-                    start_time = pygame.time.get_ticks()   
+                    sim.next_level()
                 elif event.key   == pygame.K_r:
-                    devices = []
-                    start_time = pygame.time.get_ticks()   
- 
-        light.update_rays(devices,   level.targets)   
- 
-        pygame.draw.rect(screen,   (240, 240, 240), (0, 0, toolbar_width, HEIGHT))
-        pygame.draw.rect(screen,   BLACK, (0, 0, toolbar_width, HEIGHT), 2)
-        
-        pygame.draw.rect(screen,   SILVER, mirror_btn)
-        pygame.draw.rect(screen,   BLACK, mirror_btn, 2)
-        mirror_text = small_font.render(" 添加镜子", True, BLACK)
-        screen.blit(mirror_text,   (mirror_btn.x + 10, mirror_btn.y + 10))
-        
-        pygame.draw.rect(screen,   BLUE, level_btn)
-        pygame.draw.rect(screen,   BLACK, level_btn, 2)
-        level_text = small_font.render(f" 关卡 {current_level}/5", True, WHITE)
-        screen.blit(level_text,   (level_btn.x + 10, level_btn.y + 10))
-        
-        pygame.draw.rect(screen,   RED, reset_btn)
-        pygame.draw.rect(screen,   BLACK, reset_btn, 2)
-        reset_text = small_font.render(" 重置关卡", True, WHITE)
-        screen.blit(reset_text,   (reset_btn.x + 10, reset_btn.y + 10))
-        
-        mirror_text = small_font.render(f" 镜子: {len(devices)}/{level.mirror_limit}",   True, BLACK)
-        screen.blit(mirror_text,   (20, 80))
-        
-        if level.time_limit   > 0:
-            time_text = font.render(f" 时间: {int(time_left)}秒", True, BLACK)
-            screen.blit(time_text,   (WIDTH - 200, 20))
-        
-        score_text = font.render(f" 总分: {total_score}", True, BLACK)
-        screen.blit(score_text,   (WIDTH - 200, 60))
-        
-        for obstacle in level.obstacles: 
-            obstacle.draw(screen) 
-            
-        for target in level.targets:   
-            target.draw(screen)   
- 
-        for device in devices:
-            if isinstance(device, Mirror):
-                device.draw(screen)   
- 
-        light.draw(screen)   
-        
-        hints = [
-            "操作提示:",
-            "↑/↓: 增减光线数量",
-            "←/→: 调整光线角度",
-            "点击镜子端点: 旋转",
-            "拖动镜子: 移动位置",
-            "D: 删除镜子",
-            "C: 复制镜子",
-            "空格: 重置",
-            "N: 下一关",
-            "R: 重试当前关" 
-        ]
-        
-        for i, hint in enumerate(hints):
-            hint_text = small_font.render(hint,   True, PURPLE)
-            screen.blit(hint_text,   (WIDTH - 300, HEIGHT - 250 + i * 20))
-        
-        pygame.display.flip() 
-        clock.tick(60) 
+                    sim.restart()
+
+        PROFILER.stop('events', started)
+
+        started = PROFILER.start()
+        sim.trace()
+        PROFILER.stop('trace', started)
+        if renderer.heatmap is not None:
+            started = PROFILER.start()
+            renderer.heatmap.accumulate(sim)
+            PROFILER.stop('heatmap', started)
+        started = PROFILER.start()
+        dirty = renderer.draw(sim, pygame.time.get_ticks(), alpha)
+        PROFILER.stop('render', started)
+        started = PROFILER.start()
+        if dirty:
+            pygame.display.update(dirty)
+        PROFILER.stop('flip', started)
+        PROFILER.stop('frame', frame_started)
+        PROFILER.end_frame()
+        if not shown:
+            # 第一帧已经推到屏幕上, 从这里起可以操作
+            shown = True
+            if first_frame:
+                print(f"首帧: {(time.perf_counter() - START_TIME) * 1000:.1f} ms")
+                running = False
+        dt = clock.tick(60) / 1000
+
+    if recorder is not None:
+        recorder.close()
+    if PROFILER.trace_path is not None:
+        PROFILER.dump()
  
+def run_cli(argv):
+    parser = argparse.ArgumentParser(description="光学实验室大冒险")
+    commands = parser.add_subparsers(dest='command')
+    play = commands.add_parser('play', help="开始游戏 (默认)")
+    play.add_argument('--profile-trace', help="记录各阶段耗时, 退出时写成 Chrome trace 文件")
+    play.add_argument('--levels', dest='level_file', help="关卡包文件 (JSON Lines), 默认使用内置关卡")
+    play.add_argument('--record', help="把操作录成录像文件, 之后可以用 replay 命令回放")
+    play.add_argument('--first-frame', action='store_true', help="画出第一帧后退出并报告启动用时")
+    solve = commands.add_parser('solve', help="自动求解关卡, 报告最少镜子数和一种摆法")
+    solve.add_argument('levels', nargs='*', type=int, help="关卡编号, 默认全部")
+    solve.add_argument('--workers', type=int, help="进程数, 默认为 CPU 核数")
+    solve.add_argument('--seconds', type=float, default=SOLVER_COUNT_SECONDS, help="每个镜子数的搜索时长")
+    solve.add_argument('--seed', type=int, default=0)
+    solve.add_argument('--levels', dest='level_file', help="关卡包文件, 默认使用内置关卡")
+    export = commands.add_parser('export-levels', help="把关卡写成 JSON Lines 关卡包")
+    export.add_argument('output')
+    export.add_argument('--levels', dest='level_file', help="要转存的关卡包, 默认导出内置关卡")
+    replay = commands.add_parser('replay', help="无界面快速回放录像, 报告每个录像的得分和过关情况")
+    replay.add_argument('files', nargs='+')
+    replay.add_argument('--workers', type=int, help="进程数, 默认为 CPU 核数")
+    replay.add_argument('-o', '--output', help="把结果写成 JSON 文件")
+    grade = commands.add_parser('grade', help="批量批改镜子摆法作业, 写出 CSV 或 JSON 报告")
+    grade.add_argument('submissions', help="作业文件 (JSON Lines, 每行一份)")
+    grade.add_argument('-o', '--output', required=True, help="报告文件, 扩展名为 .csv 时写 CSV, 否则写 JSON")
+    grade.add_argument('--workers', type=int, help="进程数, 默认为 CPU 核数")
+    grade.add_argument('--levels', dest='level_file', help="关卡包文件, 默认使用内置关卡")
+    serve = commands.add_parser('serve', help="多局服务器: 全班同时在瘦客户端上游戏")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=SERVER_PORT)
+    serve.add_argument('--workers', type=int, help="追踪线程数, 默认为 CPU 核数")
+    serve.add_argument('--levels', dest='level_file', help="关卡包文件, 默认使用内置关卡")
+    load = commands.add_parser('load-test', help="用替身客户端压测服务器")
+    load.add_argument('--clients', type=int, default=45)
+    load.add_argument('--seconds', type=float, default=10)
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, help="要压测的服务器端口, 不指定时在本进程内启动一个")
+    load.add_argument('--workers', type=int, help="本进程内服务器的追踪线程数")
+    load.add_argument('--levels', dest='level_file', help="本进程内服务器的关卡包")
+    load.add_argument('--seed', type=int, default=0)
+    bench = commands.add_parser('bench', help="基准测试: 光线追踪、拾取和离屏绘制")
+    bench.add_argument('-o', '--output', help="把结果写成 JSON 文件")
+    bench.add_argument('--compare', help="与之前的 JSON 结果对比, 有明显变慢时返回 1")
+    bench.add_argument('--repeat', type=int, default=BENCH_REPEAT)
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--quick', action='store_true', help="只跑少量光线数和反弹次数组合")
+    args = parser.parse_args(argv)
+    if args.command == 'solve':
+        return solve_command(args)
+    elif args.command == 'bench':
+        return bench_command(args)
+    elif args.command == 'serve':
+        serve_command(args)
+    elif args.command == 'load-test':
+        load_test_command(args)
+    elif args.command == 'replay':
+        return replay_command(args)
+    elif args.command == 'grade':
+        return grade_command(args)
+    elif args.command == 'export-levels':
+        export_levels_command(args)
+    else:
+        main(getattr(args, 'profile_trace', None), getattr(args, 'level_file', None), getattr(args, 'record', None),
+             getattr(args, 'first_frame', False))
+
 if __name__ == "__main__":
-    main()
+    sys.exit(run_cli(sys.argv[1:]))
@@ -0,0 +1,527 @@
+"""光学核心的几何测试: 已知几何的求交结果, 以及逐条、索引和批量追踪三条路径的一致性"""
+import importlib.util
+import math
+import pathlib
+import random
+
+import pytest
+
+GAME_PATH = pathlib.Path(__file__).resolve().parent.parent / "6、光学游戏 .py"
+spec = importlib.util.spec_from_file_location("optics_game", GAME_PATH)
+game = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(game)
+
+needs_numpy = pytest.mark.skipif(game.np is None, reason="批量追踪需要 NumPy")
+
+
+def make_mirror(x, y, angle, length=100):
+    mirror = game.Mirror(x, y, length)
+    mirror.angle = angle
+    return mirror
+
+
+def random_scene(seed, mirrors=12, targets=5):
+    rng = random.Random(seed)
+    devices = [make_mirror(rng.uniform(300, 1150), rng.uniform(50, 750), rng.uniform(0, 180))
+               for _ in range(mirrors)]
+    goals = [game.Target(rng.uniform(300, 1150), rng.uniform(50, 750), rng.uniform(10, 30))
+             for _ in range(targets)]
+    return devices, goals
+
+
+def assert_same_path(a, b, tol=1e-6):
+    assert len(a) == len(b)
+    for p, q in zip(a, b):
+        assert p == pytest.approx(q, abs=tol)
+
+
+def assert_matches_full_trace(sim):
+    """各光源的光线和所有目标的命中与不用缓存、带上全部目标 (含移动目标) 逐条重新追踪的结果一致"""
+    devices = sim.devices + sim.level.obstacles
+    lit = set()
+    for light in sim.lights:
+        rays, hits = [], set()
+        for angle in light.ray_angles():
+            path, target, _ = light.trace_ray_raw((light.x, light.y), angle, devices, sim.level.targets)
+            rays.append(game.clip_path(path))
+            hits.add(target)
+        hits.discard(None)
+        assert len(light.rays) == len(rays)
+        for a, b in zip(light.rays, rays):
+            assert_same_path(a, b)
+        assert light.hits == hits
+        lit |= hits
+    assert [t.hit for t in sim.level.targets] == [t in lit for t in sim.level.targets]
+
+
+def random_edit(sim, rng):
+    """随机放置、移动、旋转或移除一面镜子"""
+    ops = ['add'] * (len(sim.devices) < sim.level.mirror_limit) + ['move', 'rotate', 'remove'] * bool(sim.devices)
+    op = rng.choice(ops)
+    if op == 'add':
+        sim.add_mirror(rng.uniform(game.TOOLBAR_WIDTH, game.WIDTH), rng.uniform(0, game.HEIGHT), rng.uniform(0, 180))
+        return
+    mirror = rng.choice(sim.devices)
+    if op == 'move':
+        sim.move_mirror(mirror, mirror.x + rng.uniform(-80, 80), mirror.y + rng.uniform(-80, 80))
+    elif op == 'rotate':
+        sim.rotate_mirror(mirror, rng.uniform(-45, 45))
+    else:
+        sim.remove_mirror(mirror)
+
+
+def test_mirror_intersection_known_geometry():
+    light = game.LightSource(100, 200)
+    hit = light.mirror_intersection((100, 200), (1, 0), make_mirror(300, 200, 90))
+    assert hit['t'] == pytest.approx(200)
+    assert hit['point'] == pytest.approx((300, 200))
+    assert abs(hit['normal'][0]) == pytest.approx(1)
+    # 平行于镜面、从背后经过和射向反方向的光线都不相交
+    assert light.mirror_intersection((100, 200), (1, 0), make_mirror(300, 200, 0)) is None
+    assert light.mirror_intersection((100, 400), (1, 0), make_mirror(300, 200, 90)) is None
+    assert light.mirror_intersection((100, 200), (-1, 0), make_mirror(300, 200, 90)) is None
+
+
+def test_target_intersection_known_geometry():
+    light = game.LightSource(100, 200)
+    hit = light.target_intersection((100, 200), (1, 0), game.Target(500, 200, 30))
+    assert hit['t'] == pytest.approx(370)
+    assert hit['point'] == pytest.approx((470, 200))
+    assert light.target_intersection((100, 200), (1, 0), game.Target(500, 300, 30)) is None
+    assert light.target_intersection((100, 200), (-1, 0), game.Target(500, 200, 30)) is None
+
+
+def test_reflect():
+    light = game.LightSource(0, 0)
+    assert light.reflect((1, 0), (-1, 0)) == pytest.approx((-1, 0))
+    s = math.sqrt(0.5)
+    assert light.reflect((1, 0), (-s, s)) == pytest.approx((0, 1))
+
+
+def test_trace_ray_through_a_45_degree_mirror():
+    light = game.LightSource(100, 400)
+    target = game.Target(400, 700, 20)
+    # 屏幕坐标 y 向下, 45 度的镜子把向右的光线反射向下
+    path = light.trace_ray((100, 400), 0, [make_mirror(400, 400, 45)], [target])
+    assert target.hit
+    assert_same_path(path, [(100, 400), (400, 400), (400, 680)])
+
+
+@needs_numpy
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_trace_matches_scalar_trace(seed):
+    devices, targets = random_scene(seed)
+    light = game.LightSource(200, 400)
+    light.num_rays = 200
+    light.spread = 120
+    angles = light.ray_angles()
+    starts = [(light.x, light.y)] * len(angles)
+
+    scalar = [light.trace_ray(start, angle, devices, targets) for start, angle in zip(starts, angles)]
+    scalar_hits = {t for t in targets if t.hit}
+    for target in targets:
+        target.hit = False
+    batch = light.trace_rays(starts, angles, devices, targets)
+    assert len(angles) >= game.BATCH_MIN_RAYS  # 确实走了批量路径
+    assert {t for t in targets if t.hit} == scalar_hits
+    for a, b in zip(scalar, batch):
+        assert_same_path(a, b)
+
+    paths, hits = game.trace_rays_batch(starts, angles, devices, targets)
+    for (start, angle), path, hit in zip(zip(starts, angles), paths, hits):
+        raw, target, _ = light.trace_ray_raw(start, angle, devices, targets)
+        assert (targets[hit] if hit >= 0 else None) is target
+        assert_same_path(path, game.clip_path(raw))
+
+
+def test_frame_stats_count_traces_per_rendered_frame():
+    sim = game.Simulation(1)
+    sim.advance(game.SIM_STEP / 4)  # 不足一步, 这一帧不模拟
+    sim.trace()
+    assert sim.frame_stats['traces'] == 1
+    sim.advance(game.SIM_STEP / 4)
+    sim.add_mirror(600, 400, 45)
+    sim.trace()
+    assert sim.frame_stats['traces'] == 1
+    sim.advance(game.SIM_STEP * 3)
+    assert sim.frame_stats == {'traces': 0, 'rays': 0}
+
+
+@pytest.mark.parametrize('num_rays', [3, 40, game.TABLE_MIN_RAYS])
+@pytest.mark.parametrize('seed', range(3))
+def test_incremental_retrace_matches_full_trace(seed, num_rays):
+    rng = random.Random(seed)
+    sim = game.Simulation()
+    level = game.random_level(seed, 5, 8)
+    level.lights[0]['num_rays'] = num_rays
+    sim.use_level(level)
+    for _ in range(8):
+        sim.add_mirror(rng.uniform(300, 1100), rng.uniform(50, 750), rng.uniform(0, 180))
+    sim.trace()
+    # 光线多时缓存是 PathTable, 少时是 PathList
+    assert isinstance(sim.light.paths, game.PathTable) == (game.np is not None and num_rays >= game.TABLE_MIN_RAYS)
+    for _ in range(150):
+        for _ in range(rng.randint(1, 3)):  # 两次追踪之间可能有几处变化
+            random_edit(sim, rng)
+        sim.trace()
+        assert_matches_full_trace(sim)
+
+
+@pytest.mark.parametrize('level_num', [1, 3, 4])
+def test_incremental_retrace_matches_full_trace_on_builtin_levels(level_num):
+    rng = random.Random(level_num)
+    sim = game.Simulation(level_num)
+    sim.trace()
+    for _ in range(150):
+        random_edit(sim, rng)
+        sim.trace()
+        assert_matches_full_trace(sim)
+
+
+BOX = (10, 0, 20, 10)
+
+
+@pytest.mark.parametrize('origin, direction, expected', [
+    ((0, 5), (1, 0), (10, 20)),                  # 与 x 轴平行
+    ((15, -5), (0, 1), (5, 15)),                 # 与 y 轴平行
+    ((0, 15), (1, 0), None),                     # 平行但在 slab 之外
+    ((30, 5), (1, 0), None),                     # 盒子在射线背后
+    ((15, 5), (1, 0), (-5, 5)),                  # 起点在盒子里: 进入参数为负
+    ((0, 0), (1, 0), (10, 20)),                  # 沿下边擦过
+    ((0, 10), (1, 0), (10, 20)),                 # 沿上边擦过
+])
+def test_ray_box_intersection_edge_cases(origin, direction, expected):
+    result = game.ray_box_intersection(origin, direction, BOX)
+    if expected is None:
+        assert result is None
+    else:
+        assert result == pytest.approx(expected)
+
+
+def test_ray_box_intersection_grazes_a_corner():
+    s = math.sqrt(0.5)
+    # 从 (0, 20) 向右下方只碰到 (0, 0, 10, 10) 的角 (10, 10)
+    t_enter, t_leave = game.ray_box_intersection((0, 20), (s, -s), (0, 0, 10, 10))
+    assert t_enter == pytest.approx(t_leave)
+    assert t_enter == pytest.approx(10 / s)
+    assert game.ray_box_intersection((0, 21), (s, -s), (0, 0, 10, 10)) is None
+
+
+def test_level4_obstacle_hides_the_target():
+    sim = game.Simulation(4)
+    sim.trace()
+    target, = sim.level.targets
+    obstacle, = sim.level.obstacles
+    assert not target.hit
+    # 正对目标的光线停在障碍物的左边缘
+    path, hit, missed = sim.light.trace_ray_raw((sim.light.x, sim.light.y), 0, sim.level.obstacles,
+                                                sim.level.targets)
+    assert hit is None and not missed
+    assert path[-1] == pytest.approx((obstacle.box()[0], sim.light.y))
+    # 拿掉障碍物后同一束光就能照到目标
+    sim.level.obstacles.clear()
+    sim.index.remove(obstacle)
+    sim.mark_dirty()
+    sim.trace()
+    assert target.hit
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_scalar_indexed_and_batch_tracing_agree_in_a_maze(seed):
+    sim = game.Simulation()
+    sim.use_level(game.random_level(seed, 6, 120))
+    rng = random.Random(seed)
+    for _ in range(30):
+        sim.add_mirror(rng.randrange(game.TOOLBAR_WIDTH + 50, game.WIDTH), rng.randrange(0, game.HEIGHT),
+                       rng.uniform(0, 180))
+    light = sim.light
+    devices = sim.devices + sim.level.obstacles
+    targets = sim.static_targets
+    angles = [math.radians(a) for a in range(-60, 61)]
+    start = (light.x, light.y)
+    scalar = [light.trace_ray_raw(start, a, devices, targets) for a in angles]
+    indexed = [light.trace_ray_raw(start, a, devices, targets, game.MAX_BOUNCES, sim.index) for a in angles]
+    for (p1, t1, m1), (p2, t2, m2) in zip(scalar, indexed):
+        assert t1 is t2 and m1 == m2
+        assert_same_path(p1, p2)
+    if game.np is None:
+        return
+    points, lengths, hits, missed = game.trace_batch_arrays(
+        [start] * len(angles), angles, sim.devices, targets, game.MAX_BOUNCES, sim.level.obstacles)
+    boxes = [o.box() for o in sim.level.obstacles]
+    blocked = 0
+    for i, (path, target, miss) in enumerate(scalar):
+        assert (targets[hits[i]] if hits[i] >= 0 else None) is target
+        assert bool(missed[i]) == miss
+        assert_same_path([tuple(p) for p in points[:lengths[i], i]], path)
+        x, y = path[-1]
+        blocked += any(x0 - 1e-6 <= x <= x1 + 1e-6 and y0 - 1e-6 <= y <= y1 + 1e-6 for x0, y0, x1, y1 in boxes)
+    assert blocked  # 迷宫里确实有光线停在障碍物上
+
+
+@pytest.mark.parametrize('level_num', [0, -1, game.LEVEL_COUNT + 1, 9])
+def test_builtin_levels_reject_unknown_level_numbers(level_num):
+    with pytest.raises(ValueError):
+        game.BUILTIN_LEVELS.level(level_num)
+    with pytest.raises(ValueError):
+        game.Simulation(level_num)
+
+
+def test_solve_rejects_unknown_level_numbers(capsys):
+    assert game.run_cli(['solve', '9']) == 1
+    assert '9' in capsys.readouterr().err
+
+
+def test_profiler_ignores_stages_started_while_off():
+    profiler = game.Profiler()
+    started = profiler.start()
+    profiler.set_hud(True)  # F3 在帧中途打开面板
+    profiler.stop('events', started)
+    profiler.end_frame()
+    assert profiler.samples['events'][-1] == 0
+    started = profiler.start()
+    profiler.stop('events', started)
+    profiler.end_frame()
+    assert 0 <= profiler.samples['events'][-1] < 1000
+
+
+def write_pack(tmp_path, lines):
+    path = tmp_path / "levels.jsonl"
+    path.write_text("\n".join(lines) + "\n", encoding='utf-8')
+    return game.LevelPack(str(path))
+
+
+@pytest.mark.parametrize('line', ['[1, 2]', '3', '"level"', '{"targets": [1]}', '{"lights": [[1, 2]]}'])
+def test_level_pack_rejects_malformed_levels(tmp_path, line):
+    pack = write_pack(tmp_path, ['{"targets": []}', line])
+    assert pack.level(1).targets == []
+    with pytest.raises(ValueError):
+        pack.level(2)
+
+
+def test_level_pack_cache_keeps_recently_used_levels(tmp_path, monkeypatch):
+    monkeypatch.setattr(game, 'LEVEL_CACHE_SIZE', 2)
+    pack = write_pack(tmp_path, ['{}', '{}', '{}'])
+    first = pack.data(1)
+    pack.data(2)
+    assert pack.data(1) is first  # 再次用到第 1 关
+    pack.data(3)  # 淘汰的应是第 2 关
+    assert list(pack.cache) == [1, 3]
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+
+def path_target_level():
+    return game.GameLevel(1, {'mirror_limit': 6, 'targets': [
+        {'type': 'path', 'points': [[500, 150], [1000, 250], [900, 650], [450, 500]], 'speed': 200, 'radius': 25},
+        {'x': 1100, 'y': 400}]})
+
+
+@pytest.mark.parametrize('make_level', [lambda: game.GameLevel(2), lambda: game.GameLevel(5), path_target_level],
+                         ids=['level2', 'level5', 'path'])
+@pytest.mark.parametrize('num_rays', [3, game.TABLE_MIN_RAYS])
+def test_moving_target_hits_match_full_trace(make_level, num_rays):
+    rng = random.Random(num_rays)
+    sim = game.Simulation()
+    level = make_level()
+    level.time_limit = 0  # 不让超时换关
+    level.lights[0]['num_rays'] = num_rays
+    sim.use_level(level)
+    assert sim.movers
+    sim.trace()
+    for _ in range(250):
+        if rng.random() < 0.2:
+            random_edit(sim, rng)
+        sim.advance(rng.uniform(0.005, 0.05))
+        sim.trace()
+        assert_matches_full_trace(sim)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_recorded_session_replays_to_the_same_result(tmp_path, seed):
+    rng = random.Random(seed)
+    path = str(tmp_path / "session.rec")
+    sim = game.Recorder(game.Simulation(1), path)
+    completions = []
+    for _ in range(300):
+        op = rng.choice(['edit'] * 6 + ['release', 'next', 'wait'])
+        if op == 'edit':
+            random_edit(sim, rng)
+        elif op == 'release':
+            level = sim.level
+            if sim.release():
+                completions.append({'level': level.level_num, 'score': level.score,
+                                    'time': round(sim.steps * game.SIM_STEP, 3)})
+        elif op == 'next':
+            sim.next_level()
+        sim.advance(rng.uniform(0.001, 0.1))  # 帧时间长短不一
+        sim.trace()
+    sim.close()
+
+    result = game.replay_file(path)
+    assert result['complete']
+    assert result['total_score'] == sim.total_score
+    assert result['level'] == sim.current_level
+    assert result['completions'] == completions
+    assert completions  # 脚本里确实有过关
+
+
+@pytest.mark.parametrize('message', [
+    {'op': 'add', 'x': 'nan', 'y': 300},
+    {'op': 'add', 'x': float('inf'), 'y': 300},
+    {'op': 'add', 'x': 1e999, 'y': 300},
+    {'op': 'add', 'x': 600, 'y': 300, 'angle': float('nan')},
+    {'op': 'rays', 'value': float('inf')},
+    {'op': 'spread', 'value': 'nan'},
+])
+def test_session_rejects_non_finite_numbers(message):
+    session = game.Session(1, FakeWriter(), game.BUILTIN_LEVELS)
+    session.sim.level.mirror_limit = 5
+    with pytest.raises(ValueError):
+        session.apply(message)
+    assert session.sim.devices == []
+    session.apply({'op': 'add', 'x': 600, 'y': 300})
+    session.apply({'op': 'clear'})
+    assert session.sim.devices == []
+
+
+def test_session_clamps_coordinates_to_the_play_field():
+    session = game.Session(1, FakeWriter(), game.BUILTIN_LEVELS)
+    session.apply({'op': 'add', 'x': -500, 'y': 1e9})
+    mirror, = session.sim.devices
+    assert (mirror.x, mirror.y) == (game.TOOLBAR_WIDTH, game.HEIGHT)
+    session.apply({'op': 'rays', 'value': 1000})
+    assert session.sim.light.num_rays == 10
+
+
+def test_server_session_survives_bad_messages(monkeypatch):
+    import asyncio
+    import json
+
+    def broken_release(self):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(game.Simulation, 'release', broken_release)
+
+    async def scenario():
+        server_game, server = await game.start_server('127.0.0.1', 0, workers=1)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for message in ({'op': 'add', 'x': 'nan', 'y': 1}, {'op': 'release'}, {'op': 'add', 'x': 600, 'y': 300}):
+            writer.write((json.dumps(message) + '\n').encode())
+        errors, mirrors = [], None
+        while mirrors != 1:
+            message = json.loads(await asyncio.wait_for(reader.readline(), 5))
+            errors += [message['error']] if 'error' in message else []
+            mirrors = len(message.get('mirrors', [])) if 'mirrors' in message else mirrors
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return errors
+
+    errors = asyncio.run(scenario())
+    assert len(errors) == 2 and 'RuntimeError' in errors[1]
+
+
+def test_parallel_light_tracing_matches_serial():
+    data = game.random_level(7, 6, 20).to_dict()
+    data['lights'] = [{'x': 160, 'y': 100}, {'x': 160, 'y': 300, 'num_rays': 50, 'spread': 90},
+                      {'x': 160, 'y': 500, 'num_rays': 20}]
+    level = game.GameLevel(1, data)
+    runs = []
+    for workers in (1, 4):
+        rng = random.Random(3)
+        sim = game.Simulation(workers=workers)
+        sim.use_level(level)
+        for _ in range(20):
+            sim.add_mirror(rng.randrange(200, 1000), rng.randrange(0, 700), rng.uniform(0, 180))
+        states = []
+        for _ in range(30):
+            mirror = rng.choice(sim.devices)
+            sim.move_mirror(mirror, mirror.x + rng.randint(-30, 30), mirror.y + rng.randint(-30, 30))
+            sim.trace()
+            states.append(([t.hit for t in sim.level.targets], [light.rays for light in sim.lights]))
+        assert (sim.pool is not None) == (workers > 1 and game.np is not None)
+        runs.append(states)
+    assert runs[0] == runs[1]
+
+
+def test_parallel_light_tracing_with_moving_targets_matches_full_trace():
+    data = path_target_level().to_dict()
+    data['time_limit'] = 0
+    data['lights'] = [{'x': 200, 'y': 400, 'num_rays': game.TABLE_MIN_RAYS, 'spread': 60}, {'x': 200, 'y': 150, 'num_rays': 5},
+                      {'x': 200, 'y': 650, 'num_rays': 30, 'spread': 90}]
+    rng = random.Random(5)
+    sim = game.Simulation(workers=3)
+    sim.use_level(game.GameLevel(1, data))
+    sim.trace()
+    for _ in range(200):
+        if rng.random() < 0.3:
+            random_edit(sim, rng)
+        sim.advance(rng.uniform(0.005, 0.05))
+        sim.trace()
+        assert_matches_full_trace(sim)
+
+
+def grade_lines(submissions):
+    import json
+    lines = [s if isinstance(s, str) else json.dumps(s) for s in submissions]
+    return game.grade_chunk(1, lines)
+
+
+LEVEL3_SOLUTION = [[470, 520, 120], [1160, 140, 90], [320, 410, 30]]
+
+
+@pytest.mark.parametrize('bad', [
+    '{"level": 3, "mirrors": [[NaN, 400, 0]]}',
+    '{"level": 3, "mirrors": [[Infinity, 400, 0]]}',
+    '{"level": 3, "mirrors": [[1e999, 400, 0]]}',
+    '{"level": 3, "mirrors": [[1e300, 400, 0]]}',
+    '{"level": 3, "mirrors": [["600", 400, 0]]}',
+    '{"level": 3, "mirrors": [[600, 400]]}',
+    '{"level": 3, "mirrors": 5}',
+    '{"level": 3, "mirrors": [], "rays": Infinity}',
+    '{"level": 3, "mirrors": [], "time_left": NaN}',
+])
+def test_grader_reports_bad_submissions_and_keeps_grading(bad):
+    good = {'level': 3, 'mirrors': LEVEL3_SOLUTION}
+    results = grade_lines([good, bad, good, good])
+    assert 'error' in results[1]
+    for result in results[:1] + results[2:]:
+        assert result.get('completed') is True, result
+
+
+@pytest.mark.parametrize('level', [True, 1.0, '1'])
+def test_grader_rejects_non_integer_levels(level):
+    grader = game.Grader()
+    grader.grade({'level': 1, 'mirrors': []})  # 第 1 关已在缓存里
+    with pytest.raises(ValueError):
+        grader.grade({'level': level, 'mirrors': []})
+
+
+def test_grader_clamps_light_settings_and_time_bonus():
+    unfair, too_late, normal = grade_lines([
+        {'level': 3, 'mirrors': [], 'rays': 2000, 'spread': 360},
+        {'level': 1, 'mirrors': [], 'time_left': 100000},
+        {'level': 1, 'mirrors': [], 'time_left': 30},
+    ])
+    assert unfair['completed'] is False
+    level = game.GameLevel(1)
+    assert too_late['score'] == level.calculate_score(0, level.time_limit)
+    assert normal['score'] == level.calculate_score(0, 30)
+
+
+def test_add_mirror_with_bad_coordinates_leaves_the_scene_intact():
+    sim = game.Simulation(3)
+    with pytest.raises(ValueError):
+        sim.add_mirror(float('nan'), 400, 0)
+    assert sim.devices == []
+    sim.add_mirror(600, 400, 0)
+    sim.clear_mirrors()
+    sim.trace()
+    assert sim.devices == []